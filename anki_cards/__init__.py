@@ -0,0 +1 @@
+default_app_config = 'anki_cards.apps.AnkiCardsConfig'
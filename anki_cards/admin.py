@@ -31,7 +31,7 @@ from taggit.models import Tag
 from markupfield.fields import MarkupField
 from markupfield.widgets import AdminMarkupTextareaWidget
 from taggit.forms import TagWidget
-from .models import Deck, BaseCard, BasicCard, EnglishCard, Sleng, Issue
+from .models import Deck, BaseCard, BasicCard, EnglishCard, Sleng, Issue, ExportJob, CARD_TYPE_CHOICES
 from challenges.models import Lesson
 from reviews.models import SolutionEnhancementTemplate
 
@@ -103,21 +103,18 @@ class BaseCardsResource(resources.ModelResource):
 
     def dehydrate_tags(self, card):
         # use prefetched tags data
-        return ','.join([tag.name for tag in card.basiccard.tags.all()])
+        return ','.join([tag.name for tag in get_tags(card)])
 
     def dehydrate_card_type(self, card):
-        with suppress(ObjectDoesNotExist):
-            return card.basiccard and 'basiccard'
-        with suppress(ObjectDoesNotExist):
-            return card.englishcard and 'englishcard'
+        return card.card_type
 
     def dehydrate_basiccard_front(self, card):
-        with suppress(ObjectDoesNotExist):
+        if card.card_type == 'basiccard':
             return card.basiccard.front.raw
         return ''
 
     def dehydrate_basiccard_explanation(self, card):
-        with suppress(ObjectDoesNotExist):
+        if card.card_type == 'basiccard':
             return card.basiccard.explanation.raw
         return ''
 
@@ -226,26 +223,19 @@ class DeckAdmin(ImportExportMixin, DraggableMPTTAdmin):
 
 
 class BaseCardAddForm(forms.ModelForm):
-    card_type = forms.ChoiceField(
-        choices=(
-            ('BasicCard', 'Обычная карточка'),
-            ('EnglishCard', 'Карточки по Английскому'),
-        )
-    )
+    # BaseCard.card_type is not editable, it is filled by child model, so form field is declared explicitly
+    card_type = forms.ChoiceField(choices=CARD_TYPE_CHOICES)
 
     class Meta:
-        fields = ['card_type']
+        fields = []
         model = BaseCard
 
 
 def get_tags(base_card):
-    with suppress(ObjectDoesNotExist):
-        return base_card.basiccard.tags.all()
-
-    with suppress(ObjectDoesNotExist):
-        return base_card.englishcard.tags.all()
-
-    return []
+    typed_card = base_card.get_typed_card()
+    if typed_card is None:
+        return []
+    return typed_card.tags.all()
 
 
 def get_anki_field_preview(rendered_html):
@@ -300,7 +290,8 @@ class BaseCardAdmin(ImportExportModelAdmin):
         'englishcard__slengs__footnote_explanation',
     ]
     date_hierarchy = 'created_at'
-    list_select_related = ['basiccard', 'englishcard', 'deck', 'solution_enhancement_template', 'lesson', 'created_by']
+    # child cards are prefetched by get_queryset with one query per card type instead of LEFT JOIN to every table
+    list_select_related = ['deck', 'solution_enhancement_template', 'lesson', 'created_by']
     list_display_links = [
         'get_card_shortname',
     ]
@@ -322,9 +313,11 @@ class BaseCardAdmin(ImportExportModelAdmin):
         }
 
     def get_export_queryset(self, request):
-        return super().get_export_queryset(request).select_related('basiccard', 'englishcard', 'deck')
+        # child cards and their tags are prefetched by get_queryset, every card is loaded from its own table only
+        return super().get_export_queryset(request).select_related('deck')
 
     def get_queryset(self, request):
+        # one query per child table instead of LEFT JOIN to every table, see BaseCard.get_typed_card
         return super().get_queryset(request).prefetch_related('basiccard__tags', 'englishcard__tags')
 
     def show_creation_info(self, obj):
@@ -349,7 +342,7 @@ class BaseCardAdmin(ImportExportModelAdmin):
     def get_card_text(self, obj):
         template = '<div class="anki-cards-list-preview">{}<div>'
 
-        with suppress(ObjectDoesNotExist):
+        if obj.card_type == 'basiccard':
             card = obj.basiccard
             front_html = card.front if card.front else ''  # is already stripped by markdown renderer
             answer = card.answer if card.answer else ''
@@ -358,7 +351,7 @@ class BaseCardAdmin(ImportExportModelAdmin):
             card_html = f'{front_html} <pre class="answer"><code>{escape(answer)}</code></pre> {explanation_html}'
             return mark_safe(template.format(card_html))
 
-        with suppress(ObjectDoesNotExist):
+        if obj.card_type == 'englishcard':
             card = obj.englishcard
             phrase_html = card.phrase if card.phrase else ''  # is already stripped by markdown renderer
             translation_html = card.phrase_translation if card.phrase_translation else ''  # is already stripped by markdown renderer
@@ -404,7 +397,7 @@ class BaseCardAdmin(ImportExportModelAdmin):
         super().save_model(request, obj, form, change)
 
     def response_add(self, request, obj):
-        if request.POST['card_type'] == 'BasicCard':
+        if request.POST['card_type'] == 'basiccard':
             url = reverse('admin:anki_cards_basiccard_add')
         else:
             url = reverse('admin:anki_cards_englishcard_add')
@@ -419,14 +412,11 @@ class BaseCardAdmin(ImportExportModelAdmin):
     get_card_shortname.short_description = 'Карточка'
 
     def change_view(self, request, object_id, **kwargs):
-        card = get_object_or_404(BaseCard, id=object_id)
+        card = get_object_or_404(BaseCard.objects.only('card_type'), id=object_id)
 
-        with suppress(ObjectDoesNotExist):
-            edit_url = reverse('admin:anki_cards_basiccard_change', args=(card.basiccard.id,))
-            return HttpResponseRedirect(edit_url)
-
-        with suppress(ObjectDoesNotExist):
-            edit_url = reverse('admin:anki_cards_englishcard_change', args=(card.englishcard.id,))
+        if card.card_type:
+            # child card shares primary key with BaseCard
+            edit_url = reverse(f'admin:anki_cards_{card.card_type}_change', args=(card.id,))
             return HttpResponseRedirect(edit_url)
 
         return super().change_view(request, object_id, **kwargs)
@@ -881,3 +871,28 @@ class IssueAdmin(admin.ModelAdmin):
         template = '<span style="white-space: nowrap;">{title}</span>'
         return format_html(template, title=card_name)
     get_card_shortname.short_description = 'Карточка'
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = [
+        'id',
+        'file_name',
+        'status',
+        'progress',
+        'worker',
+        'created_at',
+        'finished_at',
+    ]
+    list_filter = [
+        'status',
+    ]
+    ordering = [
+        '-created_at',
+    ]
+
+    def has_add_permission(self, request):
+        return False  # jobs are created by API only
+
+    def has_change_permission(self, request, obj=None):
+        return False
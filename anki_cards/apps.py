@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AnkiCardsConfig(AppConfig):
     name = 'anki_cards'
+
+    def ready(self):
+        from . import checks  # noqa F401
@@ -0,0 +1,39 @@
+import os
+
+from django.conf import settings
+from django.core.checks import Error, register
+
+from .export.jobs import get_jobs_dir_path
+
+
+def is_inside_dir(path, dir_path):
+    return os.path.commonpath([os.path.realpath(path), os.path.realpath(dir_path)]) == os.path.realpath(dir_path)
+
+
+@register()
+def check_apkg_sendfile_settings(app_configs, **kwargs):
+    """Files sent with X-Accel-Redirect are addressed by URL relative to settings.ANKI_APKG_SENDFILE_ROOT."""
+    if getattr(settings, 'ANKI_APKG_SENDFILE', None) != 'x-accel-redirect':
+        return []
+
+    missing_settings = [
+        name for name in ['ANKI_APKG_SENDFILE_ROOT', 'ANKI_APKG_SENDFILE_URL'] if not getattr(settings, name, None)
+    ]
+    if missing_settings:
+        return [Error(
+            f'{", ".join(missing_settings)} should be set for X-Accel-Redirect mode.',
+            id='anki_cards.E001',
+        )]
+
+    apkg_dirs = {'ANKI_EXPORT_JOBS_DIR': get_jobs_dir_path()}
+    if getattr(settings, 'ANKI_APKG_CACHE_DIR', None):
+        apkg_dirs['ANKI_APKG_CACHE_DIR'] = settings.ANKI_APKG_CACHE_DIR
+    return [
+        Error(
+            f'{setting_name} {dir_path} is outside of ANKI_APKG_SENDFILE_ROOT, Nginx can not send files from it.',
+            hint='Move the directory inside ANKI_APKG_SENDFILE_ROOT or disable X-Accel-Redirect mode.',
+            id='anki_cards.E002',
+        )
+        for setting_name, dir_path in apkg_dirs.items()
+        if not is_inside_dir(dir_path, settings.ANKI_APKG_SENDFILE_ROOT)
+    ]
@@ -1,8 +1,8 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, INTEGER, TEXT
-from bs4 import BeautifulSoup
+from sqlalchemy import Column, Index, INTEGER, TEXT
 
 from .utils import get_int_timestamp, calc_checksum
+from .html_text import extract_text
 
 ANKI_FIELDS_DELIMITER = chr(0x1f)  # Used for Note.flds field.
 
@@ -24,6 +24,11 @@ class Revlog(Base):
     type = Column(INTEGER(), nullable=False)
 
     __tablename__ = 'revlog'
+    # Indexes are the same as Anki creates for new collection
+    __table_args__ = (
+        Index('ix_revlog_usn', 'usn'),
+        Index('ix_revlog_cid', 'cid'),
+    )
 
 
 class Card(Base):
@@ -47,6 +52,11 @@ class Card(Base):
     data = Column(TEXT(), nullable=False, default='')
 
     __tablename__ = 'cards'
+    __table_args__ = (
+        Index('ix_cards_usn', 'usn'),
+        Index('ix_cards_nid', 'nid'),
+        Index('ix_cards_sched', 'did', 'queue', 'due'),
+    )
 
 
 class Collection(Base):
@@ -81,17 +91,30 @@ class Note(Base):
     data = Column(TEXT(), nullable=False, default='')
 
     __tablename__ = 'notes'
+    __table_args__ = (
+        Index('ix_notes_usn', 'usn'),
+        Index('ix_notes_csum', 'csum'),
+    )
 
     def set_fields(self, *fields):
         self.flds = ANKI_FIELDS_DELIMITER.join(fields)
         self.update_searchable_fields()
 
     def update_searchable_fields(self):
-        flds = self.flds or ''
-        front, *_ = flds.split(ANKI_FIELDS_DELIMITER)
-        note_searchable_field = BeautifulSoup(front, 'lxml').get_text()
-        self.sfld = note_searchable_field
-        self.csum = calc_checksum(note_searchable_field)
+        self.sfld = get_searchable_field(self.flds or '')
+        self.csum = calc_checksum(self.sfld)
+
+
+def get_searchable_field(flds):
+    front, *_ = flds.split(ANKI_FIELDS_DELIMITER)
+    return extract_text(front)
+
+
+def serialize_note_fields(*fields):
+    """Return `flds`, `sfld` and `csum` column values for the note with given fields."""
+    flds = ANKI_FIELDS_DELIMITER.join(fields)
+    sfld = get_searchable_field(flds)
+    return flds, sfld, calc_checksum(sfld)
 
 
 class Grave(Base):
@@ -1,18 +1,27 @@
-import json
+import os
+import sqlite3
 import textwrap
 import tempfile
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import count
-from sqlalchemy import create_engine
+from more_itertools import chunked
 from urllib.parse import urljoin
 
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
+from django.db.models import Exists, OuterRef
 from django.urls import reverse
 from django.conf import settings
 from django.utils.html import escape
 
-from .anki2_models import Base, Card, Collection, Note
-from .utils import session_scope, export_anki_db
+from ..models import Deck
+from .anki2_models import serialize_note_fields
+from .utils import calc_checksum, export_anki_db, load_db, serialize_db, MediaFiles
 from .decks import create_deck
+from .metrics import ExportMetrics
+from .ordering import iterate_cards_in_order
+from .writers import get_collection_template, get_writer_class
 from . import lesson_card_with_input
 from . import lesson_card_english
 
@@ -20,12 +29,39 @@ __all__ = [
     'export_cards',
 ]
 
+DEFAULT_CHUNK_SIZE = 1000  # rows per executemany call, can be overriden with settings.ANKI_EXPORT_CHUNK_SIZE
+# decks with more cards are built in temporary file, can be overriden with settings.ANKI_EXPORT_IN_MEMORY_MAX_CARDS
+DEFAULT_IN_MEMORY_MAX_CARDS = 20000
+
+SOUND_REFERENCE_TEMPLATE = '[sound:{}]'
+
+CARD_TYPE_TO_MODULE = {
+    'basiccard': lesson_card_with_input,
+    'englishcard': lesson_card_english,
+}
+
 FEEDBACK_LINK_TEMPLATE = textwrap.dedent('''
     <a class="feedback-link" href="{feedback_form_url}?card={card_id}">Сообщить о проблеме</a>
 ''')
 
 
-def generate_decks_attrs(cards):
+def get_exported_decks(cards_query):
+    """Return decks with exported cards and all their ancestors ordered as a tree.
+
+    Subtrees are found by MPTT columns tree_id/lft/rght, so every deck is loaded with a single query.
+    """
+    cards_decks = Deck.objects.filter(id__in=cards_query.order_by().values('deck_id'))
+    exported_descendants = cards_decks.filter(
+        tree_id=OuterRef('tree_id'),
+        lft__gte=OuterRef('lft'),
+        rght__lte=OuterRef('rght'),
+    )
+    return Deck.objects.filter(Exists(exported_descendants)).order_by('tree_id', 'lft').only(
+        'id', 'name', 'tree_id', 'lft', 'rght',
+    )
+
+
+def generate_decks_attrs(cards_query):
     """Return list of tuples used to export decks to anki2 format.
 
     ::return:: [(deck_id, deck_index, dumped_deck, root_deck_id)]
@@ -38,143 +74,349 @@ def generate_decks_attrs(cards):
         None,  # Django ORM id of root deck if exist
     ]
 
-    generated_decks_ids = {None}
     counter = count(start=2)
+    deck_ancestors = []  # path from root deck to the current one, parents are always met before children
 
-    for card in cards:
-        if card.deck_id in generated_decks_ids:
-            continue
-
-        deck_ancestors = card.deck.get_ancestors(include_self=True)
+    for deck in get_exported_decks(cards_query):
+        while deck_ancestors and not (
+            deck_ancestors[-1].tree_id == deck.tree_id and deck_ancestors[-1].rght > deck.lft
+        ):
+            deck_ancestors.pop()
+        deck_ancestors.append(deck)
         root_deck = deck_ancestors[0]
 
-        deck_full_name_chunks = []
-        for ancestor in deck_ancestors:
-            deck_full_name_chunks.append(ancestor.name)
+        anki2_index = next(counter)
+        deck_full_name = '::'.join(ancestor.name for ancestor in deck_ancestors)
 
-            if ancestor.id in generated_decks_ids:
-                continue
+        yield [
+            deck.id,  # deck id for Django ORM
+            anki2_index,  # deck id for Anki2 SQLite database
+            create_deck(anki2_index, deck_full_name),  # dict prepared to export to Anki2 SQLite database
+            root_deck.id,  # Django ORM id of root deck if exist
+        ]
 
-            anki2_index = next(counter)
-            deck_full_name = '::'.join(deck_full_name_chunks)
 
-            yield [
-                ancestor.id,  # deck id for Django ORM
-                anki2_index,  # deck id for Anki2 SQLite database
-                create_deck(anki2_index, deck_full_name),  # dict prepared to export to Anki2 SQLite database
-                root_deck.id,  # Django ORM id of root deck if exist
-            ]
-            generated_decks_ids.add(ancestor.id)
+def generate_models_attrs(roots_card_types):
+    """Return list of tuples used to export models to anki2 format, one model per card type inside each root deck.
 
-
-def generate_models_attrs(root_decks_indexes, englishcard_flag=False):
+    ::return:: [(card_type, root_deck_index, model_index, dumped_model)]
+    """
     counter = count(start=1)
 
-    for root_deck_index in root_decks_indexes:
-        # FIXME Multiple different models can be added here per each root deck. Add more yields
+    for root_deck_index, card_type in roots_card_types:
+        if card_type not in CARD_TYPE_TO_MODULE:
+            raise ValueError(f'Cards of type {card_type!r} can not be exported, only cards with child model can')
         model_index = next(counter)
-        if englishcard_flag:
-            yield [
-                'lesson_card_english',  # slug of card type for inner usage
-                root_deck_index,
-                model_index,
-                lesson_card_english.create_model(model_id=model_index, deck_id=root_deck_index)
-            ]
+        create_model = CARD_TYPE_TO_MODULE[card_type].create_model
+        yield [
+            card_type,  # BaseCard.card_type value
+            root_deck_index,
+            model_index,
+            create_model(model_id=model_index, deck_id=root_deck_index),
+        ]
+
+
+class NotesRowsBuilder:
+    """Convert cards to rows of anki2 `notes` and `cards` tables. Media files of the cards are collected on the way."""
+
+    def __init__(self, deck_id_to_index, deck_id_to_root_index, root_and_card_type_to_model_index):
+        self.deck_id_to_index = deck_id_to_index
+        self.deck_id_to_root_index = deck_id_to_root_index
+        self.root_and_card_type_to_model_index = root_and_card_type_to_model_index
+        self.feedback_form_url = urljoin(settings.SITE_ROOT_URL, reverse('anki_feedback'))
+        self.media_files = MediaFiles()
+
+    def build_rows(self, anki2_id, card):
+        model_index = self.root_and_card_type_to_model_index[
+            (self.deck_id_to_root_index[card.deck_id], card.card_type)
+        ]
+        link = ''
+        media_replacement = None
+        if card.card_type == 'basiccard':
+            # Append feedback link to card bottom, i.e. to explanation field
+            # Alternatively can be done with layout editing inside function
+            # lesson_card_with_input.create_model, but will require progress reset for AnkiDroid app
+            link = FEEDBACK_LINK_TEMPLATE.format(
+                feedback_form_url=escape(self.feedback_form_url),
+                card_id=escape(str(card.id))
+            )
+        elif card.card_type == 'englishcard':
+            acting_voice_path = card.englishcard.acting_voice.path
+            file_name = self.media_files.add(acting_voice_path)
+            if file_name != os.path.basename(acting_voice_path):
+                # same sound is already exported with another card, reference it instead of duplicate
+                media_replacement = (
+                    SOUND_REFERENCE_TEMPLATE.format(os.path.basename(acting_voice_path)),
+                    SOUND_REFERENCE_TEMPLATE.format(file_name),
+                )
+
+        if card.anki_flds:
+            flds, sfld, csum = card.anki_flds, card.anki_sfld, card.anki_csum  # prepared on card save
         else:
-            yield [
-                'lesson_card_with_input',  # slug of card type for inner usage
-                root_deck_index,
-                model_index,
-                lesson_card_with_input.create_model(model_id=model_index, deck_id=root_deck_index)
-            ]
+            # card was not saved since fields precomputing was introduced, see backfill_anki_fields command
+            flds, sfld, csum = serialize_note_fields(*card.get_typed_card().get_anki_fields())
+        if media_replacement:
+            flds, sfld = flds.replace(*media_replacement), sfld.replace(*media_replacement)
+            csum = calc_checksum(sfld)
+        flds += link
+
+        note_row = {
+            'id': anki2_id,
+            'guid': card.guid,
+            'mid': model_index,
+            'mod': int(card.updated_at.timestamp()),  # Anki replaces imported note only with more recent one
+            'flds': flds,
+            'sfld': sfld,
+            'csum': csum,
+        }
+        card_row = {
+            'id': anki2_id,
+            'nid': anki2_id,
+            'did': self.deck_id_to_index[card.deck_id],
+        }
+        return note_row, card_row
+
+    def generate_rows(self, numbered_cards):
+        """Yield (note_row, card_row) pairs for (anki2_id, card) pairs. Ids are assigned in advance for bulk inserts."""
+        for anki2_id, card in numbered_cards:
+            yield self.build_rows(anki2_id, card)
+
+
+def build_partition(db_path, cards_query_state, numbered_cards_ids, rows_builder, writer_class, chunk_size):
+    """Write notes and cards of one partition to separate database. Return media files of the partition.
+
+    Is run in a child process, so queryset is passed as picklable (model, query) pair, not evaluated.
+    """
+    model, query = cards_query_state
+    cards_query = model.objects.all()
+    cards_query.query = query
+
+    card_id_to_anki2_id = {card_id: anki2_id for anki2_id, card_id in numbered_cards_ids}
+    cards = iterate_cards_in_order(cards_query, list(card_id_to_anki2_id), chunk_size)
+    numbered_cards = ((card_id_to_anki2_id[card.pk], card) for card in cards)  # deleted cards are skipped
 
+    db_connection = sqlite3.connect(db_path)
+    try:
+        writer = writer_class(db_connection)
+        with writer.transaction():
+            writer.create_tables(['notes', 'cards'])
+            for rows_chunk in chunked(rows_builder.generate_rows(numbered_cards), chunk_size):
+                writer.insert_rows(rows_chunk)
+    finally:
+        db_connection.close()
+    return rows_builder.media_files.pathes
+
+
+def merge_partition(db_connection, partition_db_path, media_replacements):
+    """Copy notes and cards of the partition database. Partitions have distinct ids, so no remapping is needed.
+
+    `media_replacements` maps sound references of the partition notes to references of the same files exported
+    by other partitions, so files used in several root decks are put to the archive once.
+    """
+    db_connection.execute('ATTACH DATABASE ? AS partition', (partition_db_path,))
+    try:
+        with db_connection:
+            for old_reference, new_reference in media_replacements.items():
+                notes = db_connection.execute(
+                    'SELECT id, flds, sfld FROM partition.notes WHERE instr(flds, ?) > 0',
+                    (old_reference,),
+                ).fetchall()
+                notes = [
+                    (flds.replace(old_reference, new_reference), sfld.replace(old_reference, new_reference), note_id)
+                    for note_id, flds, sfld in notes
+                ]
+                db_connection.executemany(
+                    'UPDATE partition.notes SET flds = ?, sfld = ?, csum = ? WHERE id = ?',
+                    [(flds, sfld, calc_checksum(sfld), note_id) for flds, sfld, note_id in notes],
+                )
+            db_connection.execute('INSERT INTO notes SELECT * FROM partition.notes')
+            db_connection.execute('INSERT INTO cards SELECT * FROM partition.cards')
+    finally:
+        db_connection.execute('DETACH DATABASE partition')
 
-def export_cards(result_apkg_filepath, cards_query):
-    type_of_cards = 'BasicCard'
+
+def prepare_collection_layout(cards_query):
+    """Return decks and models of anki2 collection for exported cards and builder of notes rows.
+
+    ::return:: (serialized_decks, serialized_models, rows_builder, roots_card_types)
+    """
     # prepare decks
     decks_attrs = list(generate_decks_attrs(cards_query))
     serialized_decks = {deck_index: serialized_deck for _, deck_index, serialized_deck, _ in decks_attrs}
     deck_id_to_index = {deck_id: deck_index for deck_id, deck_index, *_ in decks_attrs}
+    deck_id_to_root_index = {
+        deck_id: deck_id_to_index[root_deck_id] for deck_id, _, _, root_deck_id in decks_attrs if root_deck_id
+    }
 
     # prepare separate set of models for each root deck
-    roots_indexes = {deck_id_to_index[root_deck_id] for *_, root_deck_id in decks_attrs if root_deck_id}
-    try:
-        models_attrs = list(generate_models_attrs(roots_indexes))
-    except ObjectDoesNotExist:
-        type_of_cards = 'EnglishCard'
-        models_attrs = list(generate_models_attrs(roots_indexes, englishcard_flag=True))
+    decks_card_types = cards_query.order_by().values_list('deck_id', 'card_type').distinct()
+    roots_card_types = sorted({
+        (deck_id_to_root_index[deck_id], card_type) for deck_id, card_type in decks_card_types
+    })
+    models_attrs = list(generate_models_attrs(roots_card_types))
     serialized_models = {model_index: serialized_model for *_, model_index, serialized_model in models_attrs}
 
-    # link decks with available models
-    card_type_to_model_index = {}
-    root_to_models = {root_index: (slug, model_index) for slug, root_index, model_index, _ in models_attrs}
-    for deck_id, deck_index, _, root_deck_id in decks_attrs:
-        if deck_id is None:
-            continue  # skip Default deck
-        root_index = deck_id_to_index[root_deck_id]
-        slug, model_index = root_to_models[root_index]
-        card_type_to_model_index[(slug, deck_id)] = model_index
-
-    feedback_form_url = urljoin(settings.SITE_ROOT_URL, reverse('anki_feedback'))
-
-    with tempfile.NamedTemporaryFile(suffix='.anki2') as db_file:
-        engine = create_engine(f"sqlite:///{db_file.name}")
-        with engine.connect() as connection:
-            Base.metadata.create_all(connection)
-
-            with session_scope(connection) as session:
-                collection = Collection(
-                    conf='{}',
-                    models=json.dumps(serialized_models),
-                    decks=json.dumps(serialized_decks),
-                    dconf='{}',
-                    tags='{}',
+    # link root decks with available models
+    root_and_card_type_to_model_index = {
+        (root_index, card_type): model_index for card_type, root_index, model_index, _ in models_attrs
+    }
+
+    rows_builder = NotesRowsBuilder(deck_id_to_index, deck_id_to_root_index, root_and_card_type_to_model_index)
+    return serialized_decks, serialized_models, rows_builder, roots_card_types
+
+
+def can_fork():
+    # Django connections are closed before fork and can't be closed inside transaction without breaking it
+    return not any(connection.in_atomic_block for connection in connections.all())
+
+
+def export_cards(
+    result_apkg_filepath,
+    cards_query,
+    cards_ids=None,
+    chunk_size=None,
+    progress_callback=None,
+    processes=1,
+    metrics=None,
+):
+    """Export cards to .apkg file. Cards are exported in order of `cards_ids` if passed, by query order otherwise.
+
+    `progress_callback(exported_count, total_count)` is called after every chunk of cards written.
+    If `processes` is greater than 1, cards of different root decks are converted in parallel by child
+    processes and merged into one collection. Processes are forked, so it's for export workers and management
+    commands only, web server workers should never pass it.
+    Durations of export stages and counters are collected to `metrics` if ExportMetrics instance is passed.
+    """
+    chunk_size = chunk_size or getattr(settings, 'ANKI_EXPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    metrics = metrics or ExportMetrics()
+    writer_class = get_writer_class()
+
+    with metrics.stage('layout'):
+        serialized_decks, serialized_models, rows_builder, roots_card_types = prepare_collection_layout(cards_query)
+        cards_count = cards_query.count() if cards_ids is None else len(cards_ids)
+
+    if any(card_type == 'englishcard' for _, card_type in roots_card_types):
+        cards_query = cards_query.select_related('englishcard')  # acting voices are exported as media files
+
+    roots_count = len({root_index for root_index, _ in roots_card_types})
+    parallel = processes > 1 and roots_count > 1 and can_fork()
+
+    def write_cards(db_connection):
+        """Write notes and cards in this process. Return paths of exported media files."""
+        # Cards are consumed exactly once and by chunks, so ORM instances are not accumulated in memory
+        if cards_ids is None:
+            cards = cards_query.iterator(chunk_size=chunk_size)
+        else:
+            cards = iterate_cards_in_order(cards_query, cards_ids, chunk_size)
+        numbered_cards = enumerate(cards, start=1)
+
+        # All cards are written in a single transaction, SQLite commits are expensive
+        exported_count = 0
+        writer = writer_class(db_connection)
+        with writer.transaction():
+            # Chunk is pulled from the iterator when previous one is written, that's when queries are made
+            for cards_chunk in metrics.measure_iteration(chunked(numbered_cards, chunk_size), 'cards_query'):
+                with metrics.stage('notes_serialization'):
+                    rows_chunk = [rows_builder.build_rows(anki2_id, card) for anki2_id, card in cards_chunk]
+                with metrics.stage('sqlite_write'):
+                    writer.insert_rows(rows_chunk)
+
+                exported_count += len(rows_chunk)
+                if progress_callback:
+                    progress_callback(exported_count, cards_count)
+        return rows_builder.media_files.pathes
+
+    def write_cards_in_parallel(db_connection):
+        """Write notes and cards of every root deck in a child process. Return paths of exported media files."""
+        ordered_cards = cards_query if cards_ids is None else cards_query.order_by()
+        card_id_to_deck_id = dict(ordered_cards.values_list('pk', 'deck_id'))
+        ordered_ids = cards_ids if cards_ids is not None else list(card_id_to_deck_id)
+
+        # Ids are global positions of cards, so partial databases are merged without conflicts
+        partitions = defaultdict(list)
+        ordered_ids = [card_id for card_id in ordered_ids if card_id in card_id_to_deck_id]  # skip deleted cards
+        for anki2_id, card_id in enumerate(ordered_ids, start=1):
+            partitions[rows_builder.deck_id_to_root_index[card_id_to_deck_id[card_id]]].append((anki2_id, card_id))
+
+        cards_query_state = (cards_query.model, cards_query.query)
+        media_files = MediaFiles()  # same file can be used in several partitions
+        exported_count = 0
+
+        connections.close_all()  # child processes should not share parent database connections
+        with metrics.stage('partitions'), tempfile.TemporaryDirectory() as tmp_dir, \
+                ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = {}  # in order of partitions first cards
+            for root_index, numbered_cards_ids in partitions.items():
+                partition_db_path = os.path.join(tmp_dir, f'{root_index}.anki2')
+                future = pool.submit(
+                    build_partition,
+                    partition_db_path,
+                    cards_query_state,
+                    numbered_cards_ids,
+                    rows_builder,
+                    writer_class,
+                    chunk_size,
                 )
-                session.add(collection)
-                session.commit()
-                media_pathes = []
-
-                for card in cards_query:
-                    if type_of_cards == 'BasicCard':
-                        model_index = card_type_to_model_index[('lesson_card_with_input', card.deck_id)]
-                    else:
-                        model_index = card_type_to_model_index[('lesson_card_english', card.deck_id)]
-                    note = Note(guid=card.guid, mid=model_index)
-                    try:
-                        # Append feedback link to card bottom
-                        # Alternatively can be done with layout editing inside function
-                        # lesson_card_with_input.create_model, but will require progress reset for AnkiDroid app
-                        link = FEEDBACK_LINK_TEMPLATE.format(
-                            feedback_form_url=escape(feedback_form_url),
-                            card_id=escape(str(card.id))
-                        )
-
-                        explanation = card.basiccard.explanation.rendered + link
-                        note.set_fields(
-                            card.basiccard.front.rendered,  # use prerendered markdown prepared by django-markupfield
-                            card.basiccard.answer,  # leave empty string '' to hide input field on Anki Desktop
-                            explanation,  # use prerendered markdown prepared by django-markupfield
-                        )
-                    except card.DoesNotExist:
-                        media_pathes.append(card.englishcard.acting_voice.path)
-                        _, acting_voice_file = card.englishcard.acting_voice.name.split('/')
-                        front = f'''{card.englishcard.word}
-                                    {card.englishcard.phrase}
-                                    [sound:{acting_voice_file}]
-                                '''
-                        back = f''' {card.englishcard.phrase_translation}
-                                    {card.englishcard.word_translation}
-                                '''
-                        note.set_fields(front, back)
-
-                    session.add(note)
-                    session.commit()
-
-                    anki2_card = Card(
-                        nid=note.id,
-                        did=deck_id_to_index[card.deck_id],
-                    )
-                    session.add(anki2_card)
-                    session.commit()
-
-        export_anki_db(db_file.name, media_pathes, result_apkg_filepath)
+                futures[future] = (partition_db_path, len(numbered_cards_ids))
+
+            for future in as_completed(futures):
+                _, partition_size = futures[future]
+                exported_count += partition_size
+                if progress_callback:
+                    progress_callback(exported_count, cards_count)
+
+            # Partitions are merged in fixed order, so names of files used in several root decks are reproducible
+            for future, (partition_db_path, _) in futures.items():
+                media_replacements = {}
+                for media_path in future.result():
+                    file_name = media_files.add(media_path)
+                    if file_name != os.path.basename(media_path):
+                        old_reference = SOUND_REFERENCE_TEMPLATE.format(os.path.basename(media_path))
+                        media_replacements[old_reference] = SOUND_REFERENCE_TEMPLATE.format(file_name)
+                with metrics.stage('partitions_merge'):
+                    merge_partition(db_connection, partition_db_path, media_replacements)
+        return media_files.pathes
+
+    def write_collection(db_connection):
+        """Write whole collection to database created from template. Return paths of exported media files."""
+        writer = writer_class(db_connection)
+        with metrics.stage('sqlite_write'), writer.transaction():
+            writer.insert_collection(serialized_decks, serialized_models)
+
+        if parallel:
+            return write_cards_in_parallel(db_connection)
+        return write_cards(db_connection)
+
+    compresslevel = getattr(settings, 'ANKI_APKG_COMPRESSLEVEL', None)
+    in_memory_max_cards = getattr(settings, 'ANKI_EXPORT_IN_MEMORY_MAX_CARDS', DEFAULT_IN_MEMORY_MAX_CARDS)
+
+    if cards_count <= in_memory_max_cards:
+        # Small and medium decks are built in memory and put to the archive without temporary files
+        db_connection = sqlite3.connect(':memory:')
+        try:
+            with metrics.stage('sqlite_write'):
+                load_db(db_connection, get_collection_template())
+            media_pathes = write_collection(db_connection)
+            with metrics.stage('sqlite_write'):
+                db_content = serialize_db(db_connection)
+        finally:
+            db_connection.close()
+        with metrics.stage('zip'):
+            export_anki_db(db_content, media_pathes, result_apkg_filepath, compresslevel=compresslevel)
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.anki2') as db_file:
+            with metrics.stage('sqlite_write'):
+                db_file.write(get_collection_template())
+                db_file.flush()
+            db_connection = sqlite3.connect(db_file.name)
+            try:
+                media_pathes = write_collection(db_connection)
+            finally:
+                db_connection.close()
+            with metrics.stage('zip'):
+                export_anki_db(db_file.name, media_pathes, result_apkg_filepath, compresslevel=compresslevel)
+
+    metrics.count('cards', cards_count)
+    metrics.count('media_files', len(media_pathes))
+    metrics.count('media_bytes', sum(os.path.getsize(media_path) for media_path in media_pathes))
+    metrics.count('apkg_bytes', os.path.getsize(result_apkg_filepath))
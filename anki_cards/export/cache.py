@@ -0,0 +1,106 @@
+import os
+import time
+import tempfile
+
+from django.conf import settings
+
+__all__ = [
+    'ApkgCache',
+    'get_apkg_cache',
+]
+
+DEFAULT_MAX_SIZE = 1024 ** 3  # 1 GB
+STALE_TMP_FILE_AGE = 60 * 60  # seconds, much longer than any build, temporary file that old was left by killed process
+
+
+class ApkgCache:
+    """Directory with built .apkg files bounded by total size. Least recently used files are evicted first.
+
+    Last usage time is tracked with file mtime, so cache is shared between all worker processes.
+    Artifacts are returned opened, so file evicted by concurrent process is still readable till it is closed.
+    Artifacts are keyed by fingerprint of exported cards read from database, see `get_export_etag`,
+    so changes of cards saved by any process are never served from stale artifact. Queryset `update` and
+    `bulk_update` don't touch `auto_now` fields, so bulk changes of cards should set `updated_at` explicitly.
+    """
+
+    def __init__(self, dir_path, max_size=DEFAULT_MAX_SIZE):
+        self.dir_path = dir_path
+        self.max_size = max_size
+        os.makedirs(dir_path, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.dir_path, f'{key}.apkg')
+
+    def get(self, key):
+        """Return opened artifact file or None if there is no artifact. Caller should close the file."""
+        try:
+            apkg_file = open(self.get_path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(apkg_file.fileno())  # mark as recently used
+        return apkg_file
+
+    def build(self, key, export_func):
+        """Build artifact with `export_func(filepath)` and put it to the cache. Return opened artifact file."""
+        path = self.get_path(key)
+        # Build into temporary file first, so concurrent requests never see partially written archive
+        file_descriptor, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.dir_path)
+        os.close(file_descriptor)
+        try:
+            export_func(tmp_path)
+            apkg_file = open(tmp_path, 'rb')  # opened before it appears in cache, so it can't be evicted before
+            os.replace(tmp_path, path)
+        except:  # noqa722
+            os.remove(tmp_path)
+            raise
+
+        self.evict(keep_path=path)
+        return apkg_file
+
+    def get_etag(self, key, apkg_file):
+        """Return strong ETag of opened artifact file. Artifact built again after eviction gets another ETag."""
+        stat = os.fstat(apkg_file.fileno())
+        return f'"{key}-{stat.st_ino:x}-{stat.st_size:x}"'
+
+    def get_or_build(self, key, export_func):
+        return self.get(key) or self.build(key, export_func)
+
+    def evict(self, keep_path=None):
+        entries = []
+        stale_tmp_files_mtime = time.time() - STALE_TMP_FILE_AGE
+        with os.scandir(self.dir_path) as dir_entries:
+            for entry in dir_entries:
+                if not entry.name.endswith(('.apkg', '.tmp')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # evicted by concurrent process
+                if entry.name.endswith('.tmp'):
+                    if stat.st_mtime < stale_tmp_files_mtime:
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def get_apkg_cache():
+    """Return cache configured by settings.ANKI_APKG_CACHE_DIR or None if caching is disabled."""
+    dir_path = getattr(settings, 'ANKI_APKG_CACHE_DIR', None)
+    if not dir_path:
+        return None
+    return ApkgCache(dir_path, max_size=getattr(settings, 'ANKI_APKG_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE))
@@ -0,0 +1,77 @@
+import threading
+
+from lxml import etree
+
+__all__ = [
+    'extract_text',
+]
+
+ASCII_SPACES_TABLE = str.maketrans('', '', '\x20\x0a\x09\x0c\x0d')
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+
+
+class TextCollector:
+    """Target for lxml HTML parser which collects text the same way as BeautifulSoup(html, 'lxml').get_text().
+
+    Tree is not built at all, text chunks are joined as soon as parser reports them. Like BeautifulSoup it skips
+    comments, doctype and processing instructions and collapses whitespace-only strings outside of <pre> tags.
+    """
+
+    def __init__(self):
+        self.text_chunks = []
+        self.current_data = []
+        self.preserve_whitespace_depth = 0
+
+    def flush_data(self):
+        if not self.current_data:
+            return
+        data = ''.join(self.current_data)
+        self.current_data = []
+
+        if not self.preserve_whitespace_depth and not data.translate(ASCII_SPACES_TABLE):
+            data = '\n' if '\n' in data else ' '
+        self.text_chunks.append(data)
+
+    def start(self, tag, attrib):
+        self.flush_data()
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth += 1
+
+    def end(self, tag):
+        self.flush_data()
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth -= 1
+
+    def data(self, content):
+        self.current_data.append(content)
+
+    def comment(self, text):
+        self.flush_data()
+
+    def doctype(self, *args):
+        self.flush_data()
+
+    def pi(self, *args):
+        self.flush_data()
+
+    def close(self):
+        self.flush_data()
+        text = ''.join(self.text_chunks)
+        self.__init__()  # parser with the same target is reused for next document
+        return text
+
+
+local = threading.local()  # lxml parsers are not thread safe, but are expensive to create for every note
+
+
+def get_parser():
+    if not hasattr(local, 'parser'):
+        local.parser = etree.HTMLParser(target=TextCollector(), recover=True)
+    return local.parser
+
+
+def extract_text(html):
+    """Return text of HTML document without tags, is equal to BeautifulSoup(html, 'lxml').get_text()."""
+    parser = get_parser()
+    parser.feed(html)
+    return parser.close()
@@ -0,0 +1,221 @@
+import os
+import json
+import uuid
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from ..models import EXPORT_JOB_ACTIVE_STATUSES, ExportJob
+from .apkg import export_cards
+from .metrics import ExportMetrics, report_metrics
+from .selection import filter_exported_cards, get_export_etag, get_exported_cards
+
+__all__ = [
+    'create_export_job',
+    'claim_next_job',
+    'run_job',
+    'requeue_stale_jobs',
+    'remove_expired_jobs',
+]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_TTL = 24 * 60 * 60  # seconds
+DEFAULT_HEARTBEAT_INTERVAL = 30  # seconds, should be much less than stale timeout of `run_export_worker`
+
+
+def get_jobs_dir_path():
+    return getattr(settings, 'ANKI_EXPORT_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'anki_export_jobs'))
+
+
+def get_jobs_dir():
+    jobs_dir = get_jobs_dir_path()
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+
+def calc_params_key(export_params):
+    return hashlib.sha1(json.dumps(export_params, sort_keys=True).encode()).hexdigest()
+
+
+def create_export_job(export_params, file_name):
+    """Return (job, created) pair. Job with same params is reused until cards are changed.
+
+    Cards are compared by the same fingerprint as ETag of deck download. Raise Http404 if decks not found.
+    """
+    params_key = calc_params_key(export_params)
+    exported_decks, cards_query = filter_exported_cards(export_params)
+    cards_key = get_export_etag(export_params, exported_decks, cards_query).strip('"')
+
+    active_jobs = ExportJob.objects.filter(
+        params_key=params_key,
+        cards_key=cards_key,
+        status__in=EXPORT_JOB_ACTIVE_STATUSES,
+    )
+    job = active_jobs.first()
+    if job and job.status == 'done' and not os.path.exists(job.apkg_path):
+        active_jobs.filter(id=job.id).delete()  # file is expired, so the job is queued again
+        job = None
+    if job:
+        return job, False
+
+    try:
+        with transaction.atomic():
+            job = ExportJob.objects.create(
+                params_key=params_key,
+                params=export_params,
+                file_name=file_name,
+                cards_key=cards_key,
+            )
+    except IntegrityError:
+        # Concurrent request has just queued the same export
+        return active_jobs.get(), False
+    return job, True
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_next_job():
+    """Mark the oldest pending job as running and return it. Return None if queue is empty.
+
+    Job is claimed with compare-and-set UPDATE, so concurrent workers never get the same job.
+    """
+    pending_jobs = ExportJob.objects.filter(status='pending').order_by('created_at')
+    for job_id in pending_jobs.values_list('id', flat=True)[:10]:
+        claimed = ExportJob.objects.filter(id=job_id, status='pending').update(
+            status='running',
+            started_at=timezone.now(),
+            updated_at=timezone.now(),
+            worker=get_worker_name(),
+            claim_token=uuid.uuid4(),
+        )
+        if claimed:
+            return ExportJob.objects.get(id=job_id)
+    return None
+
+
+def get_claimed_jobs(job):
+    # Job requeued as stale may be claimed by another worker, then only that worker may change it
+    return ExportJob.objects.filter(id=job.id, status='running', claim_token=job.claim_token)
+
+
+# Heartbeat thread holds locks of its database connection while beating, so a process forked at that moment,
+# e.g. by parallel export, could inherit them locked and hang. Fork waits for the beat to finish instead.
+heartbeat_lock = threading.Lock()
+os.register_at_fork(
+    before=heartbeat_lock.acquire,
+    after_in_parent=heartbeat_lock.release,
+    after_in_child=heartbeat_lock.release,
+)
+
+
+class JobHeartbeat:
+    """Thread which touches updated_at of the running job, so slow but alive job is never requeued as stale.
+
+    Progress is reported only between chunks of cards, while layout and zip stages may take long.
+    """
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                with heartbeat_lock:
+                    get_claimed_jobs(self.job).update(updated_at=timezone.now())
+        finally:
+            with heartbeat_lock:
+                connection.close()  # thread has its own database connection
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def finish_job(job, **fields):
+    """Update the job claimed by this worker. Return False if job is claimed by another worker since."""
+    return bool(get_claimed_jobs(job).update(finished_at=timezone.now(), updated_at=timezone.now(), **fields))
+
+
+def run_job(job):
+    """Build .apkg file of the running job and mark job as done or failed."""
+    apkg_path = os.path.join(get_jobs_dir(), f'{job.id}.apkg')
+    # Every claim has its own temporary file, downloads never see partially written archive
+    tmp_path = f'{apkg_path}.{job.claim_token.hex}.tmp'
+
+    def report_progress(exported_count, total_count):
+        get_claimed_jobs(job).update(progress=exported_count / total_count, updated_at=timezone.now())
+
+    metrics = ExportMetrics()
+    heartbeat_interval = getattr(settings, 'ANKI_EXPORT_JOBS_HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL)
+    try:
+        with JobHeartbeat(job, heartbeat_interval), metrics.count_queries(), metrics.stage('total'):
+            with metrics.stage('cards_order'):
+                cards_query, cards_ids = get_exported_cards(job.params)
+            export_cards(
+                tmp_path,
+                cards_query,
+                cards_ids=cards_ids,
+                progress_callback=report_progress,
+                processes=getattr(settings, 'ANKI_EXPORT_PROCESSES', 1),
+                metrics=metrics,
+            )
+    except Exception as error:
+        logger.exception('Export job %s failed', job.id)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        finish_job(job, status='failed', error=repr(error))
+        return
+
+    with transaction.atomic():
+        # Row is locked, so job can't be requeued between the check and the rename
+        if not get_claimed_jobs(job).select_for_update().exists():
+            logger.warning('Export job %s is claimed by another worker, built file is dropped', job.id)
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, apkg_path)
+        finish_job(job, status='done', progress=1, apkg_path=apkg_path)
+    report_metrics(metrics, export_params=job.params, export_job=str(job.id))
+
+
+def requeue_stale_jobs(timeout):
+    """Return to the queue running jobs without progress for `timeout` seconds, e.g. jobs of killed workers."""
+    expiration_time = timezone.now() - timedelta(seconds=timeout)
+    return ExportJob.objects.filter(status='running', updated_at__lt=expiration_time).update(
+        status='pending',
+        progress=0,
+        claim_token=None,
+        updated_at=timezone.now(),
+    )
+
+
+def remove_expired_jobs(ttl=None):
+    """Remove finished jobs older than settings.ANKI_EXPORT_JOBS_TTL seconds together with their files."""
+    ttl = ttl or getattr(settings, 'ANKI_EXPORT_JOBS_TTL', DEFAULT_JOBS_TTL)
+    expired_jobs = ExportJob.objects.filter(
+        status__in=['done', 'failed'],
+        finished_at__lt=timezone.now() - timedelta(seconds=ttl),
+    )
+    for job_id, apkg_path in expired_jobs.values_list('id', 'apkg_path'):
+        if apkg_path:
+            try:
+                os.remove(apkg_path)
+            except FileNotFoundError:
+                pass
+        ExportJob.objects.filter(id=job_id).delete()
@@ -0,0 +1,89 @@
+import json
+import time
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+__all__ = [
+    'ExportMetrics',
+    'report_metrics',
+]
+
+logger = logging.getLogger(__name__)
+
+
+class ExportMetrics:
+    """Named stage timers and counters of a single export.
+
+    Stage may be entered several times, e.g. once per chunk of cards, its durations are summed up.
+    """
+
+    def __init__(self):
+        self.stages = {}  # stage name -> seconds, in order of first entry
+        self.counters = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        self.stages.setdefault(name, 0)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - started_at
+
+    def measure_iteration(self, iterable, stage_name):
+        """Yield items of the iterable, time spent on producing them is added to the stage."""
+        iterator = iter(iterable)
+        while True:
+            started_at = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stages[stage_name] = self.stages.get(stage_name, 0) + time.perf_counter() - started_at
+            yield item
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    @contextmanager
+    def count_queries(self):
+        """Count database queries made by the current process into `db_queries` counter."""
+        def count_query(execute, sql, params, many, context):
+            self.counters['db_queries'] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            yield
+
+    def as_dict(self):
+        return {
+            'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def get_server_timing(self):
+        """Return value of Server-Timing header, durations are shown by browser developer tools."""
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items())
+
+
+def report_metrics(metrics, **context):
+    """Log metrics and pass them to settings.ANKI_EXPORT_METRICS_HOOK, e.g. to forward them to metrics system.
+
+    Hook is a dotted path to callable with signature `hook(metrics_dict, **context)`.
+    """
+    metrics_dict = metrics.as_dict()
+    logger.info('Anki export metrics: %s', json.dumps({**metrics_dict, **context}, sort_keys=True, default=str))
+
+    hook_path = getattr(settings, 'ANKI_EXPORT_METRICS_HOOK', None)
+    if not hook_path:
+        return
+    try:
+        import_string(hook_path)(metrics_dict, **context)
+    except Exception:
+        logger.exception('Anki export metrics hook failed')  # metrics should never break downloads
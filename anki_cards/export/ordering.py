@@ -0,0 +1,117 @@
+import heapq
+import random
+from collections import defaultdict
+
+from more_itertools import chunked
+
+__all__ = [
+    'get_cards_order',
+    'iterate_cards_in_order',
+]
+
+
+class GroupsSizesTree:
+    """Sizes of cards groups in a Fenwick tree to pick a random card of several groups in O(log n)."""
+
+    def __init__(self, sizes):
+        self.tree = [0] * (len(sizes) + 1)
+        for index, size in enumerate(sizes):
+            self.add(index, size)
+
+    def add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def find(self, position):
+        """Return index of the group which holds card at `position` if cards of all groups were put in a row."""
+        index = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            next_index = index + step
+            if next_index < len(self.tree) and self.tree[next_index] <= position:
+                index = next_index
+                position -= self.tree[next_index]
+            step >>= 1
+        return index
+
+
+def spread_cards(cards, seed):
+    """Shuffle (card_id, group) pairs so that no two adjacent cards share the same group.
+
+    Cards without group (None) may be placed anywhere. Spreading is guaranteed if no group contains more
+    than half of the cards, otherwise groups are just spread as much as possible.
+    """
+    cards = list(cards)
+    random_generator = random.Random(seed)
+    random_generator.shuffle(cards)
+
+    groups_cards = defaultdict(list)
+    for card_id, group in cards:
+        groups_cards[group].append(card_id)
+    groups = list(groups_cards)
+    groups_indexes = {group: index for index, group in enumerate(groups)}
+    groups_sizes = GroupsSizesTree([len(groups_cards[group]) for group in groups])
+
+    largest_groups = [(-len(group_cards), group) for group, group_cards in groups_cards.items() if group is not None]
+    heapq.heapify(largest_groups)
+
+    ordered_ids = []
+    previous_group = None
+    for cards_left in range(len(cards), 0, -1):
+        # Heap contains outdated records of groups which have shrunk since
+        while largest_groups and -largest_groups[0][0] != len(groups_cards[largest_groups[0][1]]):
+            heapq.heappop(largest_groups)
+
+        largest_size, largest_group = (-largest_groups[0][0], largest_groups[0][1]) if largest_groups else (0, None)
+        if largest_size > cards_left // 2 and largest_group != previous_group:
+            # The rest can be spread only if the largest group takes every other place starting from this one
+            group = largest_group
+        else:
+            # Random card of any group but the previous one, like the next card of shuffled cards would be
+            excluded_size = len(groups_cards[previous_group]) if previous_group is not None else 0
+            if excluded_size == cards_left:
+                group = previous_group  # only cards of the previous group are left, neighbours are unavoidable
+            else:
+                if excluded_size:
+                    groups_sizes.add(groups_indexes[previous_group], -excluded_size)
+                group = groups[groups_sizes.find(random_generator.randrange(cards_left - excluded_size))]
+                if excluded_size:
+                    groups_sizes.add(groups_indexes[previous_group], excluded_size)
+
+        group_cards = groups_cards[group]
+        ordered_ids.append(group_cards.pop())
+        groups_sizes.add(groups_indexes[group], -1)
+        if group is not None and group_cards:
+            heapq.heappush(largest_groups, (-len(group_cards), group))
+        previous_group = group
+
+    return ordered_ids
+
+
+def get_cards_order(cards_query, seed, spread=False):
+    """Return ids of cards in pseudo random order. Same seed gives same order for same cards.
+
+    If `spread` is set, cards of the same code review enhancement will not go one after another.
+    """
+    cards = cards_query.order_by('pk').values_list('pk', 'solution_enhancement_template_id')
+
+    if spread:
+        return spread_cards(cards, seed)
+
+    cards_ids = [card_id for card_id, _ in cards]
+    random.Random(seed).shuffle(cards_ids)
+    return cards_ids
+
+
+def iterate_cards_in_order(cards_query, cards_ids, chunk_size):
+    """Yield cards in order of `cards_ids`. Only one chunk of ORM instances is kept in memory at once.
+
+    Cards deleted or unpublished since `cards_ids` were selected are skipped.
+    """
+    for ids_chunk in chunked(cards_ids, chunk_size):
+        cards_by_id = cards_query.in_bulk(ids_chunk)
+        for card_id in ids_chunk:
+            if card_id in cards_by_id:
+                yield cards_by_id[card_id]
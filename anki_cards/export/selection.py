@@ -0,0 +1,135 @@
+import json
+import hashlib
+from datetime import datetime, timezone
+
+from more_itertools import flatten
+
+from django.db.models import Count, Max
+from django.http import Http404
+from django.shortcuts import get_list_or_404
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+from ..models import BaseCard, Deck
+from .ordering import get_cards_order
+
+__all__ = [
+    'CARDS_ORDERS',
+    'InvalidExportParams',
+    'get_export_params',
+    'get_requested_decks',
+    'filter_exported_cards',
+    'order_exported_cards',
+    'get_exported_cards',
+    'get_export_etag',
+]
+
+CARDS_ORDERS = ['shuffle', 'spread']
+
+
+class InvalidExportParams(ValueError):
+    pass
+
+
+def parse_since(value):
+    """Return aware datetime from Unix timestamp or ISO 8601 string. Return None if value can't be parsed."""
+    try:
+        return datetime.fromtimestamp(float(value), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+
+    try:
+        since = parse_datetime(value)
+    except ValueError:
+        return None
+    if since and is_naive(since):
+        since = make_aware(since)
+    return since
+
+
+def get_export_params(query_params):
+    """Return normalized request params which define set of exported cards and their order.
+
+    Raise InvalidExportParams if params can't be normalized.
+    """
+    export_params = {
+        'decks': sorted({slug.strip() for slug in query_params.getlist('deck')}),
+        'lessons': sorted(set(query_params.getlist('lesson'))),
+        'enhancements': sorted(set(query_params.getlist('enhancement'))),
+        'order': query_params.get('order', 'shuffle'),
+        'since': query_params.get('since', ''),
+    }
+    # Invalid values are not echoed in messages, they are shown to the client
+    if export_params['order'] not in CARDS_ORDERS:
+        raise InvalidExportParams(f'Unknown cards order, expected one of: {", ".join(CARDS_ORDERS)}')
+    if export_params['since'] and not parse_since(export_params['since']):
+        raise InvalidExportParams('Invalid since timestamp, expected Unix timestamp or ISO 8601 datetime')
+
+    # Same request gets same cards order, so results are reproducible and can be cached
+    export_params['seed'] = query_params.get('seed') or json.dumps(export_params, sort_keys=True)
+    return export_params
+
+
+def get_requested_decks(export_params):
+    """Return decks requested by slugs. Raise Http404 if any of them is not found."""
+    requested_decks_slugs = set(export_params['decks'])
+    requested_decks = get_list_or_404(Deck, slug__in=requested_decks_slugs)
+
+    found_decks_slugs = {deck.slug for deck in requested_decks}
+    if found_decks_slugs < requested_decks_slugs:
+        raise Http404(f'Decks not found: {requested_decks_slugs - found_decks_slugs}')
+    return requested_decks
+
+
+def filter_exported_cards(export_params):
+    """Return exported decks and unordered query of exported cards. Raise Http404 if decks not found."""
+    # Cards without type have no child model with card fields, e.g. cards created as bare BaseCard
+    cards_query = BaseCard.objects.filter(published=True).exclude(card_type='')
+
+    requested_decks = get_requested_decks(export_params)
+    exported_decks = flatten([deck.get_descendants(include_self=True) for deck in requested_decks])
+    exported_decks = set(exported_decks)  # ORM objects will be compared by id
+
+    cards_query = cards_query.filter(deck__in=exported_decks)
+    lessons_slugs = export_params['lessons']
+    if lessons_slugs:
+        cards_query = cards_query.filter(lesson__slug__in=lessons_slugs)
+    enhancements_slugs = export_params['enhancements']
+    if enhancements_slugs:
+        cards_query = cards_query.filter(solution_enhancement_template__slug__in=enhancements_slugs)
+    if export_params['since']:
+        # Incremental export, Anki updates previously imported notes found by guid
+        cards_query = cards_query.filter(updated_at__gt=parse_since(export_params['since']))
+    return exported_decks, cards_query
+
+
+def order_exported_cards(export_params, cards_query):
+    """Return list of ids of exported cards in export order."""
+    # Перемешиваем подряд идущие карты на случай, если все они по одному и тому же улучшению код-ревью.
+    # Режим `spread` гарантирует, что карточки одного улучшения не попадутся подряд.
+    return get_cards_order(cards_query, export_params['seed'], spread=export_params['order'] == 'spread')
+
+
+def get_exported_cards(export_params):
+    """Return query of exported cards and list of their ids in export order. Raise Http404 if decks not found."""
+    _, cards_query = filter_exported_cards(export_params)
+    return cards_query, order_exported_cards(export_params, cards_query)
+
+
+def get_export_etag(export_params, exported_decks, cards_query):
+    """Return ETag of the export calculated from aggregates of cards and from decks trees.
+
+    Cards themselves are not loaded. There is no Last-Modified validator: deleted cards and renamed decks
+    don't move modification time of remaining cards, so If-Modified-Since would answer 304 on changed deck.
+    """
+    cards_stats = cards_query.aggregate(cards_count=Count('pk'), last_modified=Max('updated_at'))
+
+    hash_object = hashlib.sha1()
+    hash_object.update(json.dumps(export_params, sort_keys=True).encode())
+    hash_object.update(f'{cards_stats["cards_count"]},{cards_stats["last_modified"]};'.encode())
+    # Full names of decks are exported too, but renames and moves of decks don't touch cards modification time
+    decks_trees = Deck.objects.filter(tree_id__in={deck.tree_id for deck in exported_decks}).order_by('pk')
+    for deck_attrs in decks_trees.values_list('pk', 'parent_id', 'name'):
+        hash_object.update(json.dumps(deck_attrs).encode())
+
+    return f'"{hash_object.hexdigest()}"'
@@ -1,6 +1,9 @@
 import json
+import sqlite3
 import hashlib
 import zipfile
+import tempfile
+from collections import defaultdict
 from contextlib import contextmanager
 from os import path
 import time
@@ -39,15 +42,103 @@ def session_scope(bind=None):
         session.close()
 
 
-def export_anki_db(db_path, media_pathes, apkg_path='new.apkg'):
-    with zipfile.ZipFile(apkg_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
-        archive.write(db_path, 'collection.anki2')
+# Audio and images are compressed already, deflate wastes CPU on them and gains nothing
+STORED_MEDIA_EXTENSIONS = {'.mp3', '.ogg', '.m4a', '.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+
+def calc_file_digest(file_path):
+    hash_object = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(64 * 1024), b''):
+            hash_object.update(block)
+    return hash_object.digest()
+
+
+class MediaFiles:
+    """Media files of exported notes. Files with identical content are put to .apkg archive only once.
+
+    Content is hashed only for files with the same size, so unique files are read just once on archive writing.
+    """
+
+    def __init__(self):
+        self.pathes = []  # unique files in order of addition
+        self.file_names = {}  # media path -> file name referenced by notes
+        self.pathes_by_size = defaultdict(list)
+        self.digests = {}
+
+    def get_digest(self, media_path):
+        if media_path not in self.digests:
+            self.digests[media_path] = calc_file_digest(media_path)
+        return self.digests[media_path]
+
+    def add(self, media_path):
+        """Add file and return name notes should reference it with. Name differs from file name for duplicates."""
+        if media_path in self.file_names:
+            return self.file_names[media_path]
+
+        same_size_pathes = self.pathes_by_size[path.getsize(media_path)]
+        for other_path in same_size_pathes:
+            if self.get_digest(other_path) == self.get_digest(media_path):
+                file_name = self.file_names[other_path]
+                break
+        else:
+            _, file_name = path.split(media_path)
+            same_size_pathes.append(media_path)
+            self.pathes.append(media_path)
+
+        self.file_names[media_path] = file_name
+        return file_name
+
+
+def get_compress_type(file_name):
+    _, extension = path.splitext(file_name)
+    return zipfile.ZIP_STORED if extension.lower() in STORED_MEDIA_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def serialize_db(db_connection):
+    """Return content of SQLite database as bytes, as if it was read from database file."""
+    if hasattr(db_connection, 'serialize'):  # Python 3.11+
+        return db_connection.serialize()
+
+    # Older Python has backup API only, so database is copied through temporary file
+    with tempfile.NamedTemporaryFile(suffix='.anki2') as db_file:
+        file_connection = sqlite3.connect(db_file.name)
+        try:
+            db_connection.backup(file_connection)
+        finally:
+            file_connection.close()
+        return db_file.read()
+
+
+def load_db(db_connection, db_content):
+    """Replace content of in-memory SQLite database with bytes returned by `serialize_db`."""
+    if hasattr(db_connection, 'deserialize'):  # Python 3.11+
+        db_connection.deserialize(db_content)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.anki2') as db_file:
+        db_file.write(db_content)
+        db_file.flush()
+        file_connection = sqlite3.connect(db_file.name)
+        try:
+            file_connection.backup(db_connection)
+        finally:
+            file_connection.close()
+
+
+def export_anki_db(db_path, media_pathes, apkg_path='new.apkg', compresslevel=None):
+    """Write .apkg archive. `db_path` is either path to collection database file or its content as bytes."""
+    with zipfile.ZipFile(apkg_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=compresslevel) as archive:
+        if isinstance(db_path, bytes):
+            archive.writestr('collection.anki2', db_path)
+        else:
+            archive.write(db_path, 'collection.anki2')
         media = {}
         if media_pathes:
             for index, media_path in enumerate(media_pathes):
                 _, file_name = path.split(media_path)
                 # Записываем файл в .apkg
-                archive.write(media_path, str(index))
+                archive.write(media_path, str(index), compress_type=get_compress_type(file_name))
                 # Проставляем индекс : названия файла.mp3
                 media.update({index: file_name})
         archive.writestr("media", json.dumps(media))
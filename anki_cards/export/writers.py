@@ -0,0 +1,186 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from django.conf import settings
+
+from .anki2_models import Base, Card, Collection, Note
+from .utils import serialize_db
+
+__all__ = [
+    'SQLAlchemyWriter',
+    'SQLiteWriter',
+    'get_writer_class',
+    'build_collection_template',
+    'get_collection_template',
+]
+
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+
+
+def configure_db(db_connection):
+    # Database is a build artifact only, so journal and fsync are useless for it
+    db_connection.execute('PRAGMA journal_mode = OFF')
+    db_connection.execute('PRAGMA synchronous = OFF')
+    db_connection.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+
+
+def get_collection_row(serialized_decks, serialized_models):
+    return {
+        'conf': '{}',
+        'models': json.dumps(serialized_models),
+        'decks': json.dumps(serialized_decks),
+        'dconf': '{}',
+        'tags': '{}',
+    }
+
+
+class SQLAlchemyWriter:
+    """Write anki2 database with SQLAlchemy Core. Column defaults are filled in by SQLAlchemy for every row."""
+
+    def __init__(self, db_connection):
+        configure_db(db_connection)
+        self.engine = create_engine('sqlite://', creator=lambda: db_connection, poolclass=StaticPool)
+        self.connection = None
+
+    @contextmanager
+    def transaction(self):
+        with self.engine.begin() as connection:
+            self.connection = connection
+            try:
+                yield
+            finally:
+                self.connection = None
+
+    def create_tables(self, table_names=None):
+        tables = [Base.metadata.tables[name] for name in table_names] if table_names else None
+        Base.metadata.create_all(self.connection, tables=tables)
+
+    def insert_collection(self, serialized_decks, serialized_models):
+        self.connection.execute(Collection.__table__.insert(), get_collection_row(serialized_decks, serialized_models))
+
+    def insert_rows(self, rows_chunk):
+        """Insert chunk of (note_row, card_row) pairs."""
+        # executemany-style inserts, Python-side column defaults are still filled in by SQLAlchemy
+        notes_rows, cards_rows = zip(*rows_chunk)
+        self.connection.execute(Note.__table__.insert(), notes_rows)
+        self.connection.execute(Card.__table__.insert(), cards_rows)
+
+
+class TableStatements:
+    """Prepared SQL of anki2 table for stdlib sqlite3. Schema and defaults are taken from anki2_models."""
+
+    def __init__(self, table):
+        self.create_sql = str(CreateTable(table).compile(dialect=sqlite.dialect()))
+        self.create_indexes_sqls = [
+            str(CreateIndex(index).compile(dialect=sqlite.dialect()))
+            for index in sorted(table.indexes, key=lambda index: index.name)
+        ]
+        self.insert_sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table.name,
+            ', '.join(table.columns.keys()),
+            ', '.join(['?'] * len(table.columns)),
+        )
+        self.columns_getter = itemgetter(*table.columns.keys())
+        self.primary_key_names = [column.name for column in table.primary_key.columns]
+        self.default_factories = {
+            column.name: column.default for column in table.columns if column.default is not None
+        }
+
+    def get_defaults(self):
+        # Callable defaults like timestamps are computed once per export, not once per row
+        defaults = dict.fromkeys(self.primary_key_names)  # NULL is replaced with autoincremented rowid
+        defaults.update({
+            name: default.arg(None) if default.is_callable else default.arg
+            for name, default in self.default_factories.items()
+        })
+        return defaults
+
+
+TABLES_STATEMENTS = {name: TableStatements(table) for name, table in Base.metadata.tables.items()}
+
+
+class SQLiteWriter:
+    """Write anki2 database with stdlib sqlite3 module and executemany over prepared statements.
+
+    Produces the same schema and rows as SQLAlchemyWriter without per-row overhead of SQLAlchemy.
+    """
+
+    def __init__(self, db_connection):
+        configure_db(db_connection)
+        self.db_connection = db_connection
+        self.defaults = {name: statements.get_defaults() for name, statements in TABLES_STATEMENTS.items()}
+
+    @contextmanager
+    def transaction(self):
+        self.db_connection.execute('BEGIN')
+        try:
+            yield
+        except:  # noqa722
+            self.db_connection.rollback()
+            raise
+        self.db_connection.commit()
+
+    def create_tables(self, table_names=None):
+        for name in table_names or TABLES_STATEMENTS:
+            statements = TABLES_STATEMENTS[name]
+            for sql in [statements.create_sql, *statements.create_indexes_sqls]:
+                self.db_connection.execute(sql)
+
+    def insert_table_rows(self, table_name, rows):
+        statements = TABLES_STATEMENTS[table_name]
+        defaults = self.defaults[table_name]
+        get_values = statements.columns_getter
+        self.db_connection.executemany(statements.insert_sql, (get_values({**defaults, **row}) for row in rows))
+
+    def insert_collection(self, serialized_decks, serialized_models):
+        self.insert_table_rows('col', [get_collection_row(serialized_decks, serialized_models)])
+
+    def insert_rows(self, rows_chunk):
+        """Insert chunk of (note_row, card_row) pairs."""
+        notes_rows, cards_rows = zip(*rows_chunk)
+        self.insert_table_rows(Note.__tablename__, notes_rows)
+        self.insert_table_rows(Card.__tablename__, cards_rows)
+
+
+WRITERS = {
+    'sqlalchemy': SQLAlchemyWriter,
+    'sqlite3': SQLiteWriter,
+}
+
+
+def get_writer_class():
+    """Return writer backend chosen by settings.ANKI_EXPORT_WRITER, `sqlalchemy` or `sqlite3`."""
+    return WRITERS[getattr(settings, 'ANKI_EXPORT_WRITER', 'sqlalchemy')]
+
+
+def build_collection_template():
+    """Return content of empty anki2 database with all tables and indexes, but without collection row."""
+    db_connection = sqlite3.connect(':memory:')
+    try:
+        writer = SQLiteWriter(db_connection)
+        with writer.transaction():
+            writer.create_tables()
+        return serialize_db(db_connection)
+    finally:
+        db_connection.close()
+
+
+@lru_cache(maxsize=None)
+def get_collection_template():
+    """Return content of empty anki2 database which every export starts with. Is built once per process.
+
+    If settings.ANKI_EXPORT_TEMPLATE_PATH is set, file prebuilt at deploy time by `build_anki_template` is used.
+    """
+    template_path = getattr(settings, 'ANKI_EXPORT_TEMPLATE_PATH', None)
+    if not template_path:
+        return build_collection_template()
+    with open(template_path, 'rb') as template_file:
+        return template_file.read()
@@ -0,0 +1,166 @@
+"""Synthetic decks and cards for benchmarks. Cards are inserted in bulk without Node.js markdown rendering."""
+import os
+import uuid
+import random
+
+from more_itertools import chunked
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+
+from anki_cards.models import Deck, BaseCard, BasicCard, EnglishCard
+
+BASIC_FRONT_TEMPLATE = '''\
+<p>Что выведет в консоль программа из урока №{index}?</p>
+<pre><code class="language-python">numbers = [{numbers}]
+for number in numbers:
+    if number % 2:
+        print(number * {index})
+</code></pre>
+'''
+BASIC_EXPLANATION_TEMPLATE = '''\
+<p>Цикл <code>for</code> перебирает элементы списка, а <code>number % 2</code> отбирает нечётные числа.
+Подробнее в <a href="https://docs.python.org/3/tutorial/controlflow.html">документации</a>.</p>
+'''
+ENGLISH_PHRASE_TEMPLATE = '<p>The {word} is <strong>running</strong> late</p>'
+ENGLISH_TRANSLATION_TEMPLATE = '<p>{word} опаздывает</p>'
+
+ACTING_VOICE_SIZE = 4 * 1024
+DUPLICATED_VOICES_SHARE = 0.1  # same phrases are voiced by several cards
+
+
+def get_author():
+    User = get_user_model()
+    return User.objects.order_by('pk').first() or User.objects.create(username='anki-benchmark')
+
+
+def get_benchmark_slug(benchmark_id):
+    return f'benchmark-{benchmark_id}'
+
+
+def get_voices_dir(benchmark_id):
+    return f'acting_voices/{get_benchmark_slug(benchmark_id)}'
+
+
+def create_decks_tree(name, children_count, grandchildren_count, benchmark_id):
+    """Create root deck with two levels of subdecks. Return root deck and leaf decks."""
+    slug_prefix = f'{get_benchmark_slug(benchmark_id)}-{uuid.uuid4().hex[:8]}'
+    root_deck = Deck.objects.create(name=name, slug=slug_prefix)
+    leaf_decks = []
+    for child_index in range(children_count):
+        deck = Deck.objects.create(name=f'Урок {child_index}', slug=f'{slug_prefix}-{child_index}', parent=root_deck)
+        for grandchild_index in range(grandchildren_count):
+            leaf_decks.append(Deck.objects.create(
+                name=f'Тема {grandchild_index}',
+                slug=f'{slug_prefix}-{child_index}-{grandchild_index}',
+                parent=deck,
+            ))
+    return root_deck, leaf_decks
+
+
+def insert_cards(cards, batch_size=1000):
+    """Insert BasicCard or EnglishCard instances in bulk, skipping `save` with its markdown rendering.
+
+    Django can't bulk create models with multi-table inheritance, so rows of child tables are inserted by hand.
+    """
+    for cards_batch in chunked(cards, batch_size):
+        for card in cards_batch:
+            card.update_anki_fields()
+        BaseCard.objects.bulk_create([
+            BaseCard(**{field.attname: getattr(card, field.attname) for field in BaseCard._meta.concrete_fields})
+            for card in cards_batch
+        ])
+
+        # pk is not returned by bulk_create on every database backend
+        guids = [card.guid for card in cards_batch]
+        guid_to_id = dict(BaseCard.objects.filter(guid__in=guids).values_list('guid', 'id'))
+        for card in cards_batch:
+            card.id = card.basecard_ptr_id = guid_to_id[card.guid]
+
+        child_fields = type(cards_batch[0])._meta.local_concrete_fields
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+            table=connection.ops.quote_name(type(cards_batch[0])._meta.db_table),
+            columns=', '.join(connection.ops.quote_name(field.column) for field in child_fields),
+            placeholders=', '.join(['%s'] * len(child_fields)),
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(getattr(card, field.attname), connection) for field in child_fields]
+                for card in cards_batch
+            ])
+
+
+def generate_basic_cards(decks, count, author):
+    for index in range(count):
+        card = BasicCard(
+            card_type='basiccard',
+            deck=decks[index % len(decks)],
+            created_by=author,
+            published=True,
+            answer=str(index),
+            front=f'Что выведет в консоль программа из урока №{index}?',
+            explanation='Цикл `for` перебирает элементы списка',
+        )
+        numbers = ', '.join(str(number) for number in range(index % 10, index % 10 + 8))
+        card._front_rendered = BASIC_FRONT_TEMPLATE.format(index=index, numbers=numbers)
+        card._explanation_rendered = BASIC_EXPLANATION_TEMPLATE
+        yield card
+
+
+def generate_english_cards(decks, count, author, storage, voices_dir):
+    voices_contents = []
+    for index in range(count):
+        word = f'word{index}'
+        card = EnglishCard(
+            card_type='englishcard',
+            deck=decks[index % len(decks)],
+            created_by=author,
+            published=True,
+            word=word,
+            word_translation=f'слово{index}',
+            phrase=f'The {word} is **running** late',
+            phrase_translation=f'{word} опаздывает',
+        )
+        card._phrase_rendered = ENGLISH_PHRASE_TEMPLATE.format(word=word)
+        card._phrase_translation_rendered = ENGLISH_TRANSLATION_TEMPLATE.format(word=word)
+
+        # MP3 data is incompressible, so random bytes are realistic enough
+        if voices_contents and random.random() < DUPLICATED_VOICES_SHARE:
+            voice_content = random.choice(voices_contents)
+        else:
+            voice_content = b'ID3' + os.urandom(ACTING_VOICE_SIZE)
+            voices_contents.append(voice_content)
+        voice_name = os.path.join(voices_dir, f'EnglishPhraseVoice_{index}.mp3')
+        with open(storage.path(voice_name), 'wb') as voice_file:
+            voice_file.write(voice_content)
+        card.acting_voice.name = voice_name
+        yield card
+
+
+def create_synthetic_cards(cards_count, benchmark_id, english_share=0.1):
+    """Create decks trees with `cards_count` published cards. Return (decks, voices_dir).
+
+    Acting voices are written to the storage directory `voices_dir` which should be removed by caller, as well as
+    committed decks and cards, see `delete_synthetic_cards`. Remove them even if creation has failed halfway.
+    """
+    author = get_author()
+    python_root, python_decks = create_decks_tree('Python', 20, 5, benchmark_id)
+    english_root, english_decks = create_decks_tree('English', 10, 1, benchmark_id)
+
+    storage = EnglishCard.acting_voice.field.storage
+    voices_dir = get_voices_dir(benchmark_id)
+    os.makedirs(storage.path(voices_dir))
+
+    english_count = int(cards_count * english_share)
+    insert_cards(generate_basic_cards(python_decks, cards_count - english_count, author))
+    insert_cards(generate_english_cards(english_decks, english_count, author, storage, voices_dir))
+    # tree_id of previously created roots may be changed since, because trees are ordered by name
+    root_decks = list(Deck.objects.filter(pk__in=[python_root.pk, english_root.pk]))
+    return root_decks, voices_dir
+
+
+def delete_synthetic_cards(benchmark_id):
+    """Delete decks and cards created by `create_synthetic_cards` with the same `benchmark_id`."""
+    benchmark_slug = get_benchmark_slug(benchmark_id)
+    BaseCard.objects.filter(deck__slug__startswith=benchmark_slug).delete()
+    Deck.objects.filter(slug__startswith=benchmark_slug).delete()
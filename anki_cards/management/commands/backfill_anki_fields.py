@@ -0,0 +1,35 @@
+from more_itertools import chunked
+from tqdm import tqdm
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from anki_cards.models import BasicCard, EnglishCard
+
+ANKI_FIELDS = ['anki_flds', 'anki_sfld', 'anki_csum']
+UPDATED_FIELDS = [*ANKI_FIELDS, 'updated_at']  # bulk update skips auto_now, but cached decks depend on it
+
+
+class Command(BaseCommand):
+    help = 'Fill export-ready Anki note columns for cards saved before they were introduced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recalculate already filled cards too.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for card_model in [BasicCard, EnglishCard]:
+            cards_query = card_model.objects.order_by('pk')
+            if not options['all']:
+                cards_query = cards_query.filter(anki_flds='')
+
+            cards = tqdm(
+                cards_query.iterator(chunk_size=options['chunk_size']),
+                desc=f'Fill {card_model.__name__} Anki fields',
+                total=cards_query.count(),
+            )
+            for cards_chunk in chunked(cards, options['chunk_size']):
+                for card in cards_chunk:
+                    card.update_anki_fields()  # markdown is already rendered, no need to call save
+                    card.updated_at = timezone.now()
+                card_model.objects.bulk_update(cards_chunk, UPDATED_FIELDS)
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import zipfile
+import tempfile
+import tracemalloc
+from functools import partial
+from contextlib import contextmanager, nullcontext
+
+from bs4 import BeautifulSoup
+from more_itertools import chunked
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from anki_cards.models import BaseCard, EnglishCard
+from anki_cards.export.anki2_models import ANKI_FIELDS_DELIMITER
+from anki_cards.export.apkg import export_cards, prepare_collection_layout
+from anki_cards.export.html_text import extract_text
+from anki_cards.export.metrics import ExportMetrics
+from anki_cards.export.ordering import get_cards_order, iterate_cards_in_order
+from anki_cards.export.utils import calc_file_digest, export_anki_db, serialize_db, MediaFiles
+from anki_cards.export.writers import get_writer_class, WRITERS
+from ._synthetic_cards import create_synthetic_cards, delete_synthetic_cards, get_voices_dir
+
+
+def measure(func, samples, repeat):
+    """Return best time of `func` applied to every sample, in seconds per sample."""
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        for sample in samples:
+            func(sample)
+        timings.append(time.perf_counter() - started_at)
+    return min(timings) / len(samples)
+
+
+def measure_peak_memory_mb(func):
+    """Return peak size of Python memory allocated while `func` is running, in megabytes.
+
+    Unlike max RSS of the process it doesn't depend on previous runs, so results of different sizes are comparable.
+    Memory allocated by SQLite library and by child processes is not traced.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_size = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak_size / 1024 / 1024
+
+
+@contextmanager
+def measure_stage(stages, name):
+    """Save duration and count of database queries of the code block to `stages` dict."""
+    with CaptureQueriesContext(connection) as queries:
+        started_at = time.perf_counter()
+        yield
+        duration = time.perf_counter() - started_at
+    stages[name] = {
+        'seconds': round(duration, 4),
+        'queries': len(queries),
+    }
+
+
+def write_collection(writer_class, db_connection, serialized_decks, serialized_models, rows):
+    writer = writer_class(db_connection)
+    with writer.transaction():
+        writer.create_tables()
+        writer.insert_collection(serialized_decks, serialized_models)
+        for rows_chunk in chunked(rows, 1000):
+            writer.insert_rows(rows_chunk)
+
+
+def generate_synthetic_rows(count):
+    """Yield (note_row, card_row) pairs like ones made by NotesRowsBuilder, without database access."""
+    for anki2_id in range(1, count + 1):
+        front = f'<p>Что выведет в консоль программа №{anki2_id}?</p><pre><code>print({anki2_id} * 2)</code></pre>'
+        note_row = {
+            'id': anki2_id,
+            'guid': f'{anki2_id:036d}',
+            'mid': 1 + anki2_id % 3,
+            'mod': 1600000000 + anki2_id,
+            'flds': f'{front}{ANKI_FIELDS_DELIMITER}{anki2_id * 2}{ANKI_FIELDS_DELIMITER}<p>Explanation</p>',
+            'sfld': f'Что выведет в консоль программа №{anki2_id}?print({anki2_id} * 2)',
+            'csum': anki2_id * 7919,
+        }
+        card_row = {
+            'id': anki2_id,
+            'nid': anki2_id,
+            'did': 2 + anki2_id % 10,
+        }
+        yield note_row, card_row
+
+
+def dump_cards_tables(db_connection):
+    # Timestamps filled in by defaults are skipped: collection row and modification time of cards
+    return [
+        db_connection.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall(),
+        db_connection.execute('SELECT * FROM notes ORDER BY id').fetchall(),
+        db_connection.execute('SELECT id, nid, did, ord, due, data FROM cards ORDER BY id').fetchall(),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Measure performance of Anki cards export on real or synthetic cards. Results are printed as JSON.'
+
+    suites = [
+        'text-extractor',
+        'media',
+        'export',
+        'writers',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=self.suites)
+        parser.add_argument('--limit', type=int, default=1000, help='Max count of cards to run benchmark on.')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[1000, 10000, 100000],
+            help='Counts of synthetic cards for export and writers suites.',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='Count of processes for export suite. Greater than 1 requires --commit-synthetic-cards.',
+        )
+        parser.add_argument(
+            '--commit-synthetic-cards',
+            action='store_true',
+            help='Allow to commit synthetic cards to database for parallel export. Use only on throwaway database.',
+        )
+
+    def handle(self, *args, **options):
+        suite_method = getattr(self, 'run_{}'.format(options['suite'].replace('-', '_')))
+        results = suite_method(**options)
+        self.stdout.write(json.dumps({'suite': options['suite'], **results}, indent=2))
+
+    def run_text_extractor(self, limit, repeat, **options):
+        notes_fields = BaseCard.objects.exclude(anki_flds='').values_list('anki_flds', flat=True)[:limit]
+        samples = [flds.split(ANKI_FIELDS_DELIMITER)[0] for flds in notes_fields]
+        if not samples:
+            return {'error': 'No cards with Anki fields found, run backfill_anki_fields command first.'}
+
+        def extract_with_beautifulsoup(html):
+            return BeautifulSoup(html, 'lxml').get_text()
+
+        mismatches = sum(extract_text(html) != extract_with_beautifulsoup(html) for html in samples)
+        beautifulsoup_time = measure(extract_with_beautifulsoup, samples, repeat)
+        extractor_time = measure(extract_text, samples, repeat)
+
+        return {
+            'notes': len(samples),
+            'average_html_length': sum(map(len, samples)) / len(samples),
+            'beautifulsoup_us_per_note': round(beautifulsoup_time * 10 ** 6, 2),
+            'extract_text_us_per_note': round(extractor_time * 10 ** 6, 2),
+            'speedup': round(beautifulsoup_time / extractor_time, 2),
+            'mismatches': mismatches,
+        }
+
+    def run_media(self, limit, repeat, **options):
+        acting_voices = EnglishCard.objects.exclude(acting_voice='').values_list('acting_voice', flat=True)[:limit]
+        media_pathes = [EnglishCard.acting_voice.field.storage.path(name) for name in acting_voices]
+        if not media_pathes:
+            return {'error': 'No English cards with acting voice found.'}
+
+        def export_deflated(apkg_path):
+            # Same layout as export_anki_db makes, but as before per-entry compression and deduplication were
+            # introduced: every file is deflated and duplicates are stored as many times as they are used
+            with zipfile.ZipFile(apkg_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                archive.write(os.devnull, 'collection.anki2')
+                media = {}
+                for index, media_path in enumerate(media_pathes):
+                    archive.write(media_path, str(index))
+                    media[index] = os.path.basename(media_path)
+                archive.writestr('media', json.dumps(media))
+
+        def export_deduplicated(apkg_path):
+            media_files = MediaFiles()
+            for media_path in media_pathes:
+                media_files.add(media_path)
+            export_anki_db(os.devnull, media_files.pathes, apkg_path)
+
+        results = {
+            'files': len(media_pathes),
+            'unique_files': len(set(map(calc_file_digest, media_pathes))),
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, export_func in [('deflated', export_deflated), ('deduplicated', export_deduplicated)]:
+                apkg_path = os.path.join(tmp_dir, f'{name}.apkg')
+                results[f'{name}_ms'] = round(measure(export_func, [apkg_path], repeat) * 1000, 2)
+                results[f'{name}_bytes'] = os.path.getsize(apkg_path)
+
+        results['speedup'] = round(results['deflated_ms'] / results['deduplicated_ms'], 2)
+        return results
+
+    def run_export(self, sizes, processes, commit_synthetic_cards, **options):
+        if processes > 1 and not commit_synthetic_cards:
+            raise CommandError(
+                'Parallel export runs on synthetic cards committed to database, '
+                'pass --commit-synthetic-cards if the database is a throwaway one.'
+            )
+        return {'results': [self.benchmark_export(cards_count, processes) for cards_count in sizes]}
+
+    def benchmark_export(self, cards_count, processes):
+        # Synthetic cards are created inside transaction which is rolled back, database is left untouched.
+        # But export is never forked inside transaction and child processes can't see uncommitted cards,
+        # so for parallel export cards are committed and deleted afterwards.
+        rolled_back = processes == 1
+        benchmark_id = uuid.uuid4().hex[:8]
+        storage = EnglishCard.acting_voice.field.storage
+        with transaction.atomic() if rolled_back else nullcontext():
+            try:
+                decks, _ = create_synthetic_cards(cards_count, benchmark_id)
+                return self.measure_export_stages(cards_count, decks, processes)
+            finally:
+                shutil.rmtree(storage.path(get_voices_dir(benchmark_id)), ignore_errors=True)
+                if rolled_back:
+                    transaction.set_rollback(True)
+                else:
+                    delete_synthetic_cards(benchmark_id)
+
+    def measure_export_stages(self, cards_count, decks, processes):
+        cards_query = BaseCard.objects.filter(published=True, deck__tree_id__in=[deck.tree_id for deck in decks])
+        stages = {}
+
+        with measure_stage(stages, 'order'):
+            cards_ids = get_cards_order(cards_query, seed='benchmark')
+        with measure_stage(stages, 'decks_and_models'):
+            serialized_decks, serialized_models, rows_builder, _ = prepare_collection_layout(cards_query)
+        with measure_stage(stages, 'cards_query'):
+            cards = list(iterate_cards_in_order(cards_query.select_related('englishcard'), cards_ids, 1000))
+        with measure_stage(stages, 'notes_serialization'):
+            rows = list(rows_builder.generate_rows(enumerate(cards, start=1)))
+        with measure_stage(stages, 'sqlite_write'):
+            db_connection = sqlite3.connect(':memory:')
+            write_collection(get_writer_class(), db_connection, serialized_decks, serialized_models, rows)
+            db_content = serialize_db(db_connection)
+            db_connection.close()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            apkg_path = os.path.join(tmp_dir, 'stages.apkg')
+            with measure_stage(stages, 'zip'):
+                export_anki_db(db_content, rows_builder.media_files.pathes, apkg_path)
+
+            del cards, rows, db_content
+            apkg_path = os.path.join(tmp_dir, 'export.apkg')
+            export_metrics = ExportMetrics()
+            export = partial(export_cards, apkg_path, cards_query, cards_ids=cards_ids, processes=processes)
+            with measure_stage(stages, 'export_cards'):
+                export(metrics=export_metrics)
+            apkg_size = os.path.getsize(apkg_path)
+            # Tracing slows down the export, so memory is measured by separate run
+            export_peak_memory_mb = measure_peak_memory_mb(export)
+
+        return {
+            'cards': cards_count,
+            'processes': processes,
+            'parallel': 'partitions' in export_metrics.stages,  # cards of single root deck are never split
+            'stages': stages,
+            'export_cards_metrics': export_metrics.as_dict(),
+            'cards_per_second': round(cards_count / stages['export_cards']['seconds']),
+            'apkg_bytes': apkg_size,
+            'media_files': len(rows_builder.media_files.pathes),
+            'export_cards_peak_memory_mb': round(export_peak_memory_mb, 1),
+        }
+
+    def run_writers(self, sizes, repeat, **options):
+        results = []
+        for rows_count in sizes:
+            rows = list(generate_synthetic_rows(rows_count))
+            result = {'rows': rows_count}
+            dumps = []
+            for name, writer_class in WRITERS.items():
+                def write_to_memory(rows):
+                    db_connection = sqlite3.connect(':memory:')
+                    write_collection(writer_class, db_connection, {}, {}, rows)
+                    return db_connection
+
+                result[f'{name}_seconds'] = round(measure(write_to_memory, [rows], repeat), 4)
+                dumps.append(dump_cards_tables(write_to_memory(rows)))
+
+            result['speedup'] = round(result['sqlalchemy_seconds'] / result['sqlite3_seconds'], 2)
+            result['same_output'] = all(dump == dumps[0] for dump in dumps)
+            results.append(result)
+        return {'results': results}
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from anki_cards.export.writers import build_collection_template
+
+
+class Command(BaseCommand):
+    help = 'Build empty anki2 database every export starts with. Is run at deploy time, schema may change with code.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            help='Where to save template. Defaults to settings.ANKI_EXPORT_TEMPLATE_PATH.',
+        )
+
+    def handle(self, *args, **options):
+        template_path = options['path'] or getattr(settings, 'ANKI_EXPORT_TEMPLATE_PATH', None)
+        if not template_path:
+            raise CommandError('Pass template path or set ANKI_EXPORT_TEMPLATE_PATH setting.')
+
+        template_content = build_collection_template()
+        with open(template_path, 'wb') as template_file:
+            template_file.write(template_content)
+        self.stdout.write(f'Anki collection template is saved to {template_path}')
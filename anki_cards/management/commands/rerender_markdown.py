@@ -0,0 +1,174 @@
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from more_itertools import chunked
+from tqdm import tqdm
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from devman.markdown import get_script_path, get_workers_pool, render_cache
+from anki_cards.markup import get_markup_fields, get_markup_state, get_rendered_field_name, render_markup_fields
+from anki_cards.models import BaseCard, BasicCard, EnglishCard, Sleng
+from .backfill_anki_fields import ANKI_FIELDS
+
+MARKUP_MODELS = {
+    'basiccard': BasicCard,
+    'englishcard': EnglishCard,
+    'sleng': Sleng,
+}
+
+
+def load_state(state_path):
+    if not state_path or not os.path.exists(state_path):
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(state_path, state):
+    # File is replaced atomically, so interrupted command never leaves broken state
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, state_path)
+
+
+def rerender_chunk(instances, rendered_fields_names):
+    """Render markup of the instances. Return instances with changed HTML and render failures."""
+    old_htmls = [[getattr(instance, name) for name in rendered_fields_names] for instance in instances]
+    failures = render_markup_fields(instances)
+    changed_instances = [
+        instance
+        for instance, instance_old_htmls in zip(instances, old_htmls)
+        if [getattr(instance, name) for name in rendered_fields_names] != instance_old_htmls
+    ]
+    return changed_instances, failures
+
+
+def save_unedited_instances(model, instances, update_fields):
+    """Save instances whose markup text and type are not changed since they were read. Return saved instances.
+
+    Rows are locked till the end of transaction, so concurrent edit is never overwritten with HTML of old text.
+    """
+    markup_fields = get_markup_fields(model)
+    markup_columns = [column for field in markup_fields for column in [field.attname, f'{field.name}_markup_type']]
+    with transaction.atomic():
+        locked_rows = model.objects.select_for_update().filter(pk__in=[instance.pk for instance in instances])
+        current_markup = {pk: markup for pk, *markup in locked_rows.values_list('pk', *markup_columns)}
+        unedited_instances = [
+            instance
+            for instance in instances
+            if current_markup.get(instance.pk) == [
+                value for field in markup_fields for value in get_markup_state(instance, field)
+            ]
+        ]
+        model.objects.bulk_update(unedited_instances, update_fields)
+    return unedited_instances
+
+
+class Command(BaseCommand):
+    help = 'Render markdown of cards and slengs again, e.g. after update of the render script.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', choices=list(MARKUP_MODELS), default=list(MARKUP_MODELS))
+        parser.add_argument('--chunk-size', type=int, default=200, help='Rows rendered by a single Node.js call.')
+        parser.add_argument('--workers', type=int, default=4, help='Count of parallel Node.js render workers.')
+        parser.add_argument(
+            '--state-file',
+            help='Progress is saved to this file after every chunk, interrupted command continues from it.',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Render and count changes without saving them.')
+
+    def handle(self, *args, **options):
+        # Render threads share workers pool, so it should be large enough for all of them
+        get_workers_pool(get_script_path('render_anki_md.js'), size=options['workers'])
+
+        state = load_state(options['state_file'])
+        failed_count = 0
+        for model_name in options['models']:
+            failed_count += self.rerender_model(MARKUP_MODELS[model_name], state, options)['failed']
+        self.stdout.write(f'Render cache: {dict(render_cache.stats)}')
+
+        if failed_count:
+            message = f'Markdown of {failed_count} rows failed to render'
+            if options['state_file'] and not options['dry_run']:
+                message += ', they are rendered again by the next run with the same state file'
+            raise CommandError(message)
+        if options['state_file'] and os.path.exists(options['state_file']) and not options['dry_run']:
+            os.remove(options['state_file'])  # everything is rendered, next run starts from the beginning
+
+    def rerender_model(self, model, state, options):
+        """Render markup of all model instances. Return stats with counts of rows, changed and failed instances.
+
+        State of the model keeps last rendered pk and pks of failed rows, which are rendered again on resume.
+        """
+        state_key = model._meta.label
+        rendered_fields_names = [get_rendered_field_name(field) for field in get_markup_fields(model)]
+        update_fields = rendered_fields_names
+        if issubclass(model, BaseCard):
+            # Exported notes depend on HTML, and Anki updates imported notes only if modification time is changed
+            update_fields = [*rendered_fields_names, *ANKI_FIELDS, 'updated_at']
+
+        model_state = state.setdefault(state_key, {'last_pk': None, 'failed_pks': []})
+        retried_pks = model_state['failed_pks']
+        queryset = model.objects.order_by('pk')
+        if model_state['last_pk'] is not None:
+            queryset = queryset.filter(Q(pk__gt=model_state['last_pk']) | Q(pk__in=retried_pks))
+
+        stats = {'rows': 0, 'changed': 0, 'skipped': 0, 'failed': 0}
+        failed_pks = set()
+        started_at = time.monotonic()
+        progress_bar = tqdm(desc=f'Render {model.__name__} markdown', total=queryset.count())
+
+        def save_chunk(instances, future):
+            changed_instances, failures = future.result()
+            for instance, field, error in failures:
+                self.stderr.write(f'{model.__name__} {instance.pk} {field.name}: {error}')
+                failed_pks.add(instance.pk)
+            if issubclass(model, BaseCard):
+                for card in changed_instances:
+                    card.update_anki_fields()
+                    card.updated_at = timezone.now()
+
+            saved_instances = changed_instances
+            if not options['dry_run']:
+                # Edited rows were rendered on save from the new text, their HTML is already up to date
+                saved_instances = save_unedited_instances(model, changed_instances, update_fields)
+                # Retried rows go first, as pks of them are less than the last one
+                model_state['last_pk'] = max(instances[-1].pk, model_state['last_pk'] or 0)
+                model_state['failed_pks'] = sorted(
+                    failed_pks | {pk for pk in retried_pks if pk > instances[-1].pk},
+                )
+                if options['state_file']:
+                    save_state(options['state_file'], state)
+
+            stats['rows'] += len(instances)
+            stats['changed'] += len(saved_instances)
+            stats['skipped'] += len(changed_instances) - len(saved_instances)
+            progress_bar.update(len(instances))
+
+        # Rows are read and saved by main thread, render threads only wait for Node.js workers
+        with ThreadPoolExecutor(options['workers']) as executor:
+            pending_chunks = deque()  # chunks are saved in order, so saved state never skips unsaved rows
+            for instances in chunked(queryset.iterator(chunk_size=options['chunk_size']), options['chunk_size']):
+                future = executor.submit(rerender_chunk, instances, rendered_fields_names)
+                pending_chunks.append((instances, future))
+                if len(pending_chunks) > options['workers'] * 2:
+                    save_chunk(*pending_chunks.popleft())
+            while pending_chunks:
+                save_chunk(*pending_chunks.popleft())
+        progress_bar.close()
+        stats['failed'] = len(failed_pks)
+
+        seconds = time.monotonic() - started_at
+        self.stdout.write(
+            f'{model.__name__}: {stats["rows"]} rows, {stats["changed"]} changed, {stats["skipped"]} edited meanwhile, '
+            f'{stats["failed"]} failed in {seconds:.1f}s, {stats["rows"] / max(seconds, 0.001):.0f} rows/s',
+        )
+        return stats
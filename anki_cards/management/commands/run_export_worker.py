@@ -0,0 +1,57 @@
+import time
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from anki_cards.export.jobs import claim_next_job, run_job, requeue_stale_jobs, remove_expired_jobs
+
+
+def run_worker(poll_interval, stale_timeout, once):
+    while True:
+        job = claim_next_job()
+        if job:
+            run_job(job)
+            continue
+
+        # queue is empty, time to clean up
+        requeue_stale_jobs(stale_timeout)
+        remove_expired_jobs()
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = 'Build queued deck exports. Any number of workers may be run on one or several hosts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Count of worker processes.')
+        parser.add_argument('--poll-interval', type=float, default=1, help='Seconds to wait for new jobs.')
+        parser.add_argument(
+            '--stale-timeout',
+            type=int,
+            default=600,
+            help='Seconds without heartbeat after which running job is considered abandoned and is requeued.',
+        )
+        parser.add_argument('--once', action='store_true', help='Exit when queue is empty.')
+
+    def handle(self, *args, **options):
+        worker_kwargs = {
+            'poll_interval': options['poll_interval'],
+            'stale_timeout': options['stale_timeout'],
+            'once': options['once'],
+        }
+        if options['processes'] == 1:
+            run_worker(**worker_kwargs)
+            return
+
+        connections.close_all()  # forked processes should not share database connections
+        processes = [
+            multiprocessing.Process(target=run_worker, kwargs=worker_kwargs)
+            for _ in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
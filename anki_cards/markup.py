@@ -0,0 +1,162 @@
+from collections import defaultdict
+
+from django.utils.html import escape
+from markupfield.fields import MarkupField
+
+from devman.markdown import BulkRenderError, render_anki_markdown_in_bulk
+
+__all__ = [
+    'BulkRenderedMarkupField',
+    'BulkRenderedMarkupMixin',
+    'get_markup_fields',
+    'get_markup_state',
+    'get_rendered_field_name',
+    'render_markup_fields',
+    'prerender_markup',
+]
+
+# Markup types rendered with one Node.js call for many texts, other types are rendered text by text
+BULK_RENDERERS = {
+    'anki_markdown': render_anki_markdown_in_bulk,
+}
+
+
+def get_markup_fields(model):
+    return [field for field in model._meta.fields if isinstance(field, MarkupField)]
+
+
+def get_rendered_field_name(field):
+    return f'_{field.name}_rendered'  # column with HTML is added to the model by django-markupfield
+
+
+def render_in_bulk(markup_type, field, texts):
+    """Return list of HTML and dict of errors by text position."""
+    bulk_renderer = BULK_RENDERERS.get(markup_type)
+    if not bulk_renderer:
+        return [field.markup_choices_dict[markup_type](text) for text in texts], {}
+    try:
+        return bulk_renderer(texts), {}
+    except BulkRenderError as error:
+        return error.htmls, error.errors
+
+
+def render_markup_targets(targets):
+    """Render list of (instance, field) pairs with one bulk render call per markup type.
+
+    Return list of (instance, field, error) of failed renders, their HTML is not changed.
+    """
+    markup_type_to_targets = defaultdict(list)
+    for instance, field in targets:
+        markup = getattr(instance, field.name)
+        if markup.raw is None:
+            setattr(instance, get_rendered_field_name(field), None)
+            continue
+        markup_type_to_targets[markup.markup_type].append((instance, field))
+
+    failures = []
+    for markup_type, targets in markup_type_to_targets.items():
+        texts = []
+        for instance, field in targets:
+            raw = getattr(instance, field.name).raw
+            texts.append(escape(raw) if field.escape_html else raw)
+
+        # Fields of one markup type have the same renderer, so any of them can be passed
+        htmls, errors = render_in_bulk(markup_type, targets[0][1], texts)
+        for position, ((instance, field), html) in enumerate(zip(targets, htmls)):
+            if position in errors:
+                failures.append((instance, field, errors[position]))
+            else:
+                setattr(instance, get_rendered_field_name(field), html)
+    return failures
+
+
+def render_markup_fields(instances, fields_names=None):
+    """Render MarkupFields of model instances with one bulk render call per markup type.
+
+    HTML is set to `_<field>_rendered` attributes like django-markupfield does on save, so instances are ready
+    to be saved with `bulk_update` or with `save` skipping render. Render all markup fields by default or only
+    fields with `fields_names`. Return list of (instance, field, error) of failed renders, their HTML is not changed.
+    """
+    return render_markup_targets([
+        (instance, field)
+        for instance in instances
+        for field in get_markup_fields(type(instance))
+        if fields_names is None or field.name in fields_names
+    ])
+
+
+def is_markup_loaded(instance, field):
+    # Markup of deferred fields is not loaded, its descriptor fails on access
+    return field.attname in instance.__dict__ and f'{field.name}_markup_type' in instance.__dict__
+
+
+def get_markup_state(instance, field):
+    markup = getattr(instance, field.name)
+    return markup.raw, markup.markup_type
+
+
+def remember_rendered_markup(instance, fields):
+    """Mark HTML of the fields as rendered from their current text and markup type."""
+    rendered_markup = instance.__dict__.setdefault('_rendered_markup', {})
+    for field in fields:
+        rendered_markup[field.name] = get_markup_state(instance, field)
+
+
+def is_markup_rendered(instance, field):
+    rendered_markup = instance.__dict__.get('_rendered_markup', {})
+    return field.name in rendered_markup and rendered_markup[field.name] == get_markup_state(instance, field)
+
+
+def is_markup_changed(instance, field):
+    return is_markup_loaded(instance, field) and not is_markup_rendered(instance, field)
+
+
+def prerender_markup(instances):
+    """Render changed markup fields of instances before save with one bulk render call per markup type.
+
+    Markup is changed if its text or markup type differ from the ones its HTML was rendered from. Pass all
+    instances of a batch, e.g. of a formset, to render them together. Raise ValueError if any render fails.
+    """
+    targets = [
+        (instance, field)
+        for instance in instances
+        for field in get_markup_fields(type(instance))
+        if isinstance(field, BulkRenderedMarkupField) and is_markup_changed(instance, field)
+    ]
+    if not targets:
+        return
+    failures = render_markup_targets(targets)
+    if failures:
+        instance, field, error = failures[0]
+        raise ValueError(f'Markup of {type(instance).__name__}.{field.name} is not rendered: {error}')
+    for instance, field in targets:
+        remember_rendered_markup(instance, [field])
+
+
+class BulkRenderedMarkupField(MarkupField):
+    """MarkupField which keeps HTML prerendered by `prerender_markup` instead of rendering text on every save."""
+
+    def pre_save(self, model_instance, add):
+        if is_markup_loaded(model_instance, self) and is_markup_rendered(model_instance, self):
+            return getattr(model_instance, self.attname).raw
+        return super().pre_save(model_instance, add)
+
+
+class BulkRenderedMarkupMixin:
+    """Model mixin rendering all changed BulkRenderedMarkupFields of the instance with one render call on save.
+
+    django-markupfield renders every field separately at `pre_save`, and even if its text was not changed.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # HTML loaded from database is rendered from the loaded text
+        remember_rendered_markup(instance, [
+            field for field in get_markup_fields(cls) if is_markup_loaded(instance, field)
+        ])
+        return instance
+
+    def save(self, *args, **kwargs):
+        prerender_markup([self])
+        super().save(*args, **kwargs)
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.13 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anki_cards', '0058_issue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basecard',
+            name='anki_csum',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='Контрольная сумма поля для поиска'),
+        ),
+        migrations.AddField(
+            model_name='basecard',
+            name='anki_flds',
+            field=models.TextField(blank=True, editable=False, verbose_name='Поля заметки Anki'),
+        ),
+        migrations.AddField(
+            model_name='basecard',
+            name='anki_sfld',
+            field=models.TextField(blank=True, editable=False, verbose_name='Поле для поиска в Anki'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.13 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+def fill_card_type(apps, schema_editor):
+    BaseCard = apps.get_model('anki_cards', 'BaseCard')
+    BasicCard = apps.get_model('anki_cards', 'BasicCard')
+    EnglishCard = apps.get_model('anki_cards', 'EnglishCard')
+
+    BaseCard.objects.filter(id__in=BasicCard.objects.values('pk')).update(card_type='basiccard')
+    BaseCard.objects.filter(id__in=EnglishCard.objects.values('pk')).update(card_type='englishcard')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anki_cards', '0059_basecard_anki_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basecard',
+            name='card_type',
+            field=models.CharField(choices=[('basiccard', 'Обычная карточка'), ('englishcard', 'Карточка по Английскому')], db_index=True, default='', editable=False, help_text='Allows to find out child model without queries to every child table', max_length=20, verbose_name='Тип карточки'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_card_type, migrations.RunPython.noop),
+    ]
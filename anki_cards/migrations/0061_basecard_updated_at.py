@@ -0,0 +1,27 @@
+# Generated by Django 3.1.13 on 2026-10-18 13:05
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def fill_updated_at(apps, schema_editor):
+    BaseCard = apps.get_model('anki_cards', 'BaseCard')
+    BaseCard.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anki_cards', '0060_basecard_card_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basecard',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now, verbose_name='изменено'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.13 on 2026-10-18 13:40
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anki_cards', '0061_basecard_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('params_key', models.CharField(db_index=True, help_text='Hash of normalized export params, is used to deduplicate jobs', max_length=40, verbose_name='Ключ параметров')),
+                ('params', models.JSONField(verbose_name='Параметры экспорта')),
+                ('file_name', models.CharField(max_length=200, verbose_name='Имя файла')),
+                ('cards_key', models.CharField(help_text='Hash of exported cards aggregates and decks trees, jobs built before cards change are stale', max_length=40, verbose_name='Ключ карточек')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Собирается'), ('done', 'Готово'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=20, verbose_name='Статус')),
+                ('progress', models.FloatField(default=0, verbose_name='Прогресс')),
+                ('apkg_path', models.CharField(blank=True, max_length=500, verbose_name='Путь к файлу')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name='Обработчик')),
+                ('claim_token', models.UUIDField(blank=True, editable=False, help_text='Is changed by every claim of the job, so requeued job is finished only by the worker claimed it last', null=True, verbose_name='Токен захвата')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Создано')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='Изменено')),
+            ],
+            options={
+                'verbose_name': 'Экспорт колод',
+                'verbose_name_plural': 'Экспорты колод',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='exportjob',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['pending', 'running', 'done']), fields=('params_key', 'cards_key'), name='unique_active_export_job'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.13 on 2026-10-18 03:17
+
+import anki_cards.markup
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anki_cards', '0062_exportjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='basiccard',
+            name='explanation',
+            field=anki_cards.markup.BulkRenderedMarkupField(blank=True, rendered_field=True, verbose_name='Объяснение ответа'),
+        ),
+        migrations.AlterField(
+            model_name='basiccard',
+            name='front',
+            field=anki_cards.markup.BulkRenderedMarkupField(rendered_field=True, verbose_name='Фронтальная сторона'),
+        ),
+        migrations.AlterField(
+            model_name='englishcard',
+            name='phrase',
+            field=anki_cards.markup.BulkRenderedMarkupField(rendered_field=True, verbose_name='Фраза (подлежащее + сказуемое)'),
+        ),
+        migrations.AlterField(
+            model_name='englishcard',
+            name='phrase_translation',
+            field=anki_cards.markup.BulkRenderedMarkupField(rendered_field=True, verbose_name='Перевод фразы'),
+        ),
+        migrations.AlterField(
+            model_name='sleng',
+            name='footnote_explanation',
+            field=anki_cards.markup.BulkRenderedMarkupField(rendered_field=True, verbose_name='Пояснение в сноске'),
+        ),
+    ]
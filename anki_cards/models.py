@@ -1,3 +1,4 @@
+import os
 import uuid
 
 from django.db import models
@@ -5,12 +6,13 @@ from django.conf import settings
 from django.utils import timezone
 
 from mptt.models import MPTTModel, TreeForeignKey
-from markupfield.fields import MarkupField
 from taggit.managers import TaggableManager
 
 from challenges.models import Lesson
 from reviews.models import SolutionEnhancementTemplate
 from devman.markdown import render_anki_markdown
+from .export.anki2_models import serialize_note_fields
+from .markup import BulkRenderedMarkupField, BulkRenderedMarkupMixin, prerender_markup
 from dvmn_users.models import DvmnUser
 
 
@@ -20,6 +22,12 @@ STAGE_MODERATION_CHOICES = [
     ('approved', 'Одобрена'),
 ]
 
+# Values are names of child models, which are also names of BaseCard reverse relations to them
+CARD_TYPE_CHOICES = [
+    ('basiccard', 'Обычная карточка'),
+    ('englishcard', 'Карточка по Английскому'),
+]
+
 
 class Deck(MPTTModel):
     name = models.CharField('Название', max_length=100)
@@ -45,9 +53,9 @@ class Deck(MPTTModel):
         order_insertion_by = ['name']
 
 
-class Sleng(models.Model):
+class Sleng(BulkRenderedMarkupMixin, models.Model):
     word_with_synonyms = models.CharField('Слово + синонимы', max_length=200)
-    footnote_explanation = MarkupField(
+    footnote_explanation = BulkRenderedMarkupField(
         'Пояснение в сноске', markup_type='anki_markdown',
         markup_choices=[('anki_markdown', render_anki_markdown)]
     )
@@ -69,9 +77,17 @@ def generate_card_guid():
     return str(uuid.uuid1())
 
 
-class BaseCard(models.Model):
+class BaseCard(BulkRenderedMarkupMixin, models.Model):
     """Use multi-table inheritance to provide same changelist page in admin UI for cards of any type."""
 
+    card_type = models.CharField(
+        'Тип карточки',
+        max_length=20,
+        choices=CARD_TYPE_CHOICES,
+        editable=False,
+        db_index=True,
+        help_text='Allows to find out child model without queries to every child table',
+    )
     guid = models.CharField(
         max_length=36,  # 36 symbols are common uuid hash length.
         unique=True,
@@ -120,6 +136,12 @@ class BaseCard(models.Model):
         related_name='basecards',
     )
     created_at = models.DateTimeField('создано', default=timezone.now, db_index=True)
+    updated_at = models.DateTimeField('изменено', auto_now=True, db_index=True)
+
+    # Export-ready values of Anki note columns, are filled on save to avoid HTML processing during export
+    anki_flds = models.TextField('Поля заметки Anki', blank=True, editable=False)
+    anki_sfld = models.TextField('Поле для поиска в Anki', blank=True, editable=False)
+    anki_csum = models.BigIntegerField('Контрольная сумма поля для поиска', null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = 'Карточка'
@@ -128,9 +150,26 @@ class BaseCard(models.Model):
             ('editor', 'can edit cards and add cards to deck'),
         )
 
+    def save(self, *args, **kwargs):
+        if type(self) is not BaseCard:
+            self.card_type = self._meta.model_name
+        super().save(*args, **kwargs)
+
+    def get_typed_card(self):
+        """Return BasicCard or EnglishCard instance. Only the table of that model is queried."""
+        if type(self) is not BaseCard:
+            return self
+        if not self.card_type:
+            return None
+        return getattr(self, self.card_type)
+
+    def update_anki_fields(self):
+        """Prepare note columns for export to Anki with fields returned by child model `get_anki_fields` method."""
+        self.anki_flds, self.anki_sfld, self.anki_csum = serialize_note_fields(*self.get_anki_fields())
+
 
 class BasicCard(BaseCard):
-    front = MarkupField(
+    front = BulkRenderedMarkupField(
         'Фронтальная сторона', markup_type='anki_markdown',
         markup_choices=[('anki_markdown', render_anki_markdown)]
     )
@@ -138,7 +177,7 @@ class BasicCard(BaseCard):
         'Правильный ответ', blank=True,
         help_text='Что укажет пользователь в поле ввода. ' +
                   'Если пусто, то в карточке вместо поля ввода будет Кнопка "Показать ответ".')
-    explanation = MarkupField(
+    explanation = BulkRenderedMarkupField(
         'Объяснение ответа', markup_type='anki_markdown', blank=True,
         markup_choices=[('anki_markdown', render_anki_markdown)]
     )
@@ -150,18 +189,30 @@ class BasicCard(BaseCard):
     def __str__(self):
         return f'Карточка номер {self.id}'
 
+    def save(self, *args, **kwargs):
+        prerender_markup([self])  # anki fields are built from HTML, so all markup is rendered before save
+        self.update_anki_fields()
+        super().save(*args, **kwargs)
+
+    def get_anki_fields(self):
+        return [
+            self.front.rendered,  # use markdown prerendered before save
+            self.answer,  # leave empty string '' to hide input field on Anki Desktop
+            self.explanation.rendered,  # use markdown prerendered before save
+        ]
+
 
 class EnglishCard(BaseCard):
     word = models.CharField(max_length=100, verbose_name='Слово', blank=True)
     # back side of anki
     word_translation = models.CharField(max_length=100, verbose_name='Перевод слова')
     # front side of anki
-    phrase = MarkupField(
+    phrase = BulkRenderedMarkupField(
         'Фраза (подлежащее + сказуемое)', markup_type='anki_markdown',
         markup_choices=[('anki_markdown', render_anki_markdown)],
     )
     # back side of anki
-    phrase_translation = MarkupField(
+    phrase_translation = BulkRenderedMarkupField(
         'Перевод фразы', markup_type='anki_markdown',
         markup_choices=[('anki_markdown', render_anki_markdown)],
     )
@@ -177,6 +228,19 @@ class EnglishCard(BaseCard):
     def __str__(self):
         return f'Англо-Карточка номер {self.id}'
 
+    def save(self, *args, **kwargs):
+        prerender_markup([self])  # anki fields are built from HTML, so all markup is rendered before save
+        self.update_anki_fields()
+        super().save(*args, **kwargs)
+
+    def get_anki_fields(self):
+        acting_voice_file = os.path.basename(self.acting_voice.name)
+        # Indentation is a part of exported fields, changed fields make Anki update every imported note
+        indent, last_indent = ' ' * 36, ' ' * 32
+        front = f'{self.word}\n{indent}{self.phrase}\n{indent}[sound:{acting_voice_file}]\n{last_indent}'
+        back = f' {self.phrase_translation}\n{indent}{self.word_translation}\n{last_indent}'
+        return [front, back]
+
 
 class Issue(models.Model):
     card = models.ForeignKey(
@@ -201,3 +265,70 @@ class Issue(models.Model):
     class Meta:
         verbose_name = 'Тикет'
         verbose_name_plural = 'Тикеты'
+
+
+EXPORT_JOB_STATUS_CHOICES = [
+    ('pending', 'В очереди'),
+    ('running', 'Собирается'),
+    ('done', 'Готово'),
+    ('failed', 'Ошибка'),
+]
+EXPORT_JOB_ACTIVE_STATUSES = ['pending', 'running', 'done']  # failed jobs are never reused
+
+
+class ExportJob(models.Model):
+    """Deck export built in background by `run_export_worker` command. Pending jobs are queue of the worker."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    params_key = models.CharField(
+        'Ключ параметров',
+        max_length=40,
+        db_index=True,
+        help_text='Hash of normalized export params, is used to deduplicate jobs',
+    )
+    params = models.JSONField('Параметры экспорта')
+    file_name = models.CharField('Имя файла', max_length=200)
+    cards_key = models.CharField(
+        'Ключ карточек',
+        max_length=40,
+        help_text='Hash of exported cards aggregates and decks trees, jobs built before cards change are stale',
+    )
+    status = models.CharField(
+        'Статус',
+        max_length=20,
+        choices=EXPORT_JOB_STATUS_CHOICES,
+        default='pending',
+        db_index=True,
+    )
+    progress = models.FloatField('Прогресс', default=0)
+    apkg_path = models.CharField('Путь к файлу', max_length=500, blank=True)
+    error = models.TextField('Ошибка', blank=True)
+    worker = models.CharField('Обработчик', max_length=100, blank=True)
+    claim_token = models.UUIDField(
+        'Токен захвата',
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=(
+            'Is changed by every claim of the job, so requeued job is finished only by the worker claimed it last'
+        ),
+    )
+    created_at = models.DateTimeField('Создано', default=timezone.now, db_index=True)
+    started_at = models.DateTimeField('Начато', null=True, blank=True)
+    finished_at = models.DateTimeField('Завершено', null=True, blank=True)
+    updated_at = models.DateTimeField('Изменено', auto_now=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Экспорт колод'
+        verbose_name_plural = 'Экспорты колод'
+        constraints = [
+            # Concurrent requests of the same export never queue it twice
+            models.UniqueConstraint(
+                fields=['params_key', 'cards_key'],
+                condition=models.Q(status__in=EXPORT_JOB_ACTIVE_STATUSES),
+                name='unique_active_export_job',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Экспорт {self.id}'
@@ -1,3 +1,1184 @@
-from django.test import TestCase
+import os
+import json
+import uuid
+import importlib
+import shutil
+import sqlite3
+import zipfile
+import tempfile
+import time
+from io import BytesIO, StringIO
+from datetime import timedelta
+from functools import partial
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from bs4 import BeautifulSoup
+
+from django.apps import apps
+from django.contrib.admin.sites import site
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.http import QueryDict
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from devman import markdown
+from . import markup
+from .admin import BaseCardAdmin, BaseCardsResource
+from .management.commands import rerender_markdown
+from .checks import check_apkg_sendfile_settings
+from .models import Deck, BaseCard, BasicCard, EnglishCard, ExportJob, Sleng
+from .export.anki2_models import ANKI_FIELDS_DELIMITER
+from .export.cache import ApkgCache, STALE_TMP_FILE_AGE
+from .export.apkg import can_fork, export_cards, generate_decks_attrs
+from .export.utils import calc_checksum
+from .export.jobs import claim_next_job, create_export_job, requeue_stale_jobs, run_job
+from .export.selection import get_exported_cards, get_export_params, order_exported_cards
+from .export.ordering import iterate_cards_in_order, spread_cards
+from .export.html_text import extract_text
+from .export.utils import load_db, MediaFiles
+from .export.writers import get_collection_template, SQLAlchemyWriter, SQLiteWriter
+from .views import send_apkg_file, send_built_apkg_file
+
+
+# Render script in worker mode, wraps markdown into paragraph, crashes on `crash` text, never answers `hang`
+# text and prints unframed warning before response to `warn` text
+WORKER_SCRIPT = '''
+let buffer = Buffer.alloc(0);
+process.stdin.on('data', (chunk) => {
+  buffer = Buffer.concat([buffer, chunk]);
+  let newline;
+  while ((newline = buffer.indexOf('\\n')) >= 0) {
+    const end = newline + 1 + parseInt(buffer.slice(0, newline).toString());
+    if (buffer.length < end) return;
+    const text = buffer.slice(newline + 1, end).toString();
+    buffer = buffer.slice(end);
+    if (text === 'crash') process.exit(1);
+    if (text === 'hang') continue;
+    if (text === 'warn') process.stdout.write('DeprecationWarning: punycode is deprecated\\n');
+    const html = Buffer.from(`<p>${text}</p>`);
+    process.stdout.write(`ok ${html.length}\\n`);
+    process.stdout.write(html);
+  }
+});
+'''
+
+# Render script without worker mode, reads markdown chunks joined with BEL till the end of STDIN
+# and wraps every chunk into paragraph, crashes if any chunk is `crash`
+SCRIPT_WITHOUT_WORKER_MODE = '''
+const chunks = [];
+process.stdin.on('data', (chunk) => chunks.push(chunk));
+process.stdin.on('end', () => {
+  const texts = Buffer.concat(chunks).toString().split('\\x07');
+  if (texts.includes('crash')) process.exit(1);
+  process.stdout.write(texts.map((text) => `<p>${text}</p>`).join('\\x07'));
+});
+'''
+
+
+class SendfileSettingsCheckTest(SimpleTestCase):
+
+    @override_settings(
+        ANKI_APKG_SENDFILE='x-accel-redirect',
+        ANKI_APKG_SENDFILE_ROOT='/var/www/apkg',
+        ANKI_APKG_SENDFILE_URL='/protected/apkg/',
+        ANKI_APKG_CACHE_DIR='/var/www/apkg/cache',
+        ANKI_EXPORT_JOBS_DIR='/var/cache/anki_export_jobs',
+    )
+    def test_apkg_dirs_should_be_inside_sendfile_root(self):
+        errors = check_apkg_sendfile_settings(None)
+        self.assertEqual([error.id for error in errors], ['anki_cards.E002'])
+        self.assertIn('ANKI_EXPORT_JOBS_DIR', errors[0].msg)
+
+
+class GenerateDecksAttrsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username='card_author')
+
+    def create_decks_tree(self, root_slug, children_count):
+        root_deck = Deck.objects.create(name=root_slug.title(), slug=root_slug)
+        for index in range(children_count):
+            deck = Deck.objects.create(name=f'Deck {index}', slug=f'{root_slug}-{index}', parent=root_deck)
+            subdeck = Deck.objects.create(name='Subdeck', slug=f'{root_slug}-{index}-sub', parent=deck)
+            BaseCard.objects.create(deck=subdeck, created_by=self.user, published=True)
+
+    def test_queries_count_does_not_depend_on_decks_count(self):
+        self.create_decks_tree('small', children_count=1)
+        self.create_decks_tree('large', children_count=30)
+
+        for root_slug in ['small', 'large']:
+            with self.subTest(root_slug=root_slug):
+                cards_query = BaseCard.objects.filter(deck__tree_id=Deck.objects.get(slug=root_slug).tree_id)
+                with self.assertNumQueries(1):
+                    list(generate_decks_attrs(cards_query.order_by('?')))
+
+    def test_full_names_are_built_from_ancestors(self):
+        self.create_decks_tree('python', children_count=2)
+        Deck.objects.create(name='Empty', slug='python-empty', parent=Deck.objects.get(slug='python'))
+
+        decks_attrs = list(generate_decks_attrs(BaseCard.objects.all()))
+
+        deck_names = [serialized_deck['name'] for _, _, serialized_deck, _ in decks_attrs]
+        self.assertEqual(deck_names, [
+            'Default',
+            'Python',
+            'Python::Deck 0',
+            'Python::Deck 0::Subdeck',
+            'Python::Deck 1',
+            'Python::Deck 1::Subdeck',
+        ])
+        root_deck_id = Deck.objects.get(slug='python').id
+        self.assertEqual({root_id for *_, root_id in decks_attrs[1:]}, {root_deck_id})
+        self.assertEqual([deck_index for _, deck_index, *_ in decks_attrs], list(range(1, 7)))
+
+
+class SpreadCardsTest(SimpleTestCase):
+
+    def test_same_group_cards_are_not_adjacent(self):
+        cards = [(card_id, card_id % 3 or None) for card_id in range(30)]
+        cards += [(card_id, 1) for card_id in range(30, 40)]
+        card_groups = dict(cards)
+
+        cards_ids = spread_cards(cards, seed='seed')
+
+        self.assertCountEqual(cards_ids, card_groups.keys())
+        for card_id, next_card_id in zip(cards_ids, cards_ids[1:]):
+            group = card_groups[card_id]
+            if group is not None:
+                self.assertNotEqual(group, card_groups[next_card_id])
+
+    def test_order_is_reproducible(self):
+        cards = [(card_id, card_id % 4) for card_id in range(100)]
+        self.assertEqual(spread_cards(cards, seed='1'), spread_cards(cards, seed='1'))
+        self.assertNotEqual(spread_cards(cards, seed='1'), spread_cards(cards, seed='2'))
+
+    def test_majority_group_is_spread_as_much_as_possible(self):
+        # Large enough to take minutes if each card is searched for among the rest
+        cards = [(card_id, 1 if card_id % 10 < 7 else card_id % 10) for card_id in range(100000)]
+        card_groups = dict(cards)
+
+        cards_ids = spread_cards(cards, seed='seed')
+
+        self.assertCountEqual(cards_ids, card_groups.keys())
+        adjacent_pairs = Counter(
+            card_groups[card_id]
+            for card_id, next_card_id in zip(cards_ids, cards_ids[1:])
+            if card_groups[card_id] == card_groups[next_card_id]
+        )
+        self.assertEqual(adjacent_pairs, {1: 70000 - 30000 - 1})
+
+
+class IterateCardsInOrderTest(TestCase):
+
+    def test_deleted_cards_are_skipped(self):
+        author = get_user_model().objects.create(username='card_author')
+        deck = Deck.objects.create(name='Python', slug='python')
+        cards = [BaseCard.objects.create(deck=deck, created_by=author) for _ in range(3)]
+        cards_ids = [cards[2].pk, cards[0].pk, cards[1].pk]
+        cards[0].delete()  # e.g. by admin while export job is running
+
+        self.assertEqual(list(iterate_cards_in_order(BaseCard.objects.all(), cards_ids, chunk_size=2)), cards[2:0:-1])
+
+
+class ExtractTextTest(SimpleTestCase):
+    # Is checked against BeautifulSoup output because searchable fields of already exported notes were made with it
+    html_samples = [
+        '',
+        ' \n ',
+        'plain text',
+        '  <p>Что выведет в консоль?</p>  ',
+        '<p>first</p>\n\n<p>second</p>\n',
+        '<pre><code class="language-bash">$ echo a &gt; a.txt\n  $ cat a.txt\n</code></pre>',
+        '<pre><code>  \n </code></pre>',
+        '<textarea> </textarea>',
+        'x <b> </b> y <i>\t</i> z',
+        'a &amp; b &lt;c&gt; &nbsp; &#x1F600; &unknown;',
+        '<!-- comment --> text <!DOCTYPE html> <?pi x?>',
+        '<p>line<br>break <img src="a.png" alt="image"></p>',
+        'a < b > c',
+        '<p>unclosed <b>tags',
+        '</p>stray closing tag',
+        '<ul>\n  <li>one</li>\n  <li>two</li>\n</ul>\n<table><tr><td>1</td> <td>2</td></tr></table>',
+        'w0\n    <p>phrase</p>\n    [sound:EnglishPhraseVoice.mp3]\n',
+    ]
+
+    def test_text_equals_beautifulsoup_text(self):
+        for html in self.html_samples:
+            with self.subTest(html=html):
+                self.assertEqual(extract_text(html), BeautifulSoup(html, 'lxml').get_text())
+
+    def test_parser_is_reusable(self):
+        self.assertEqual(extract_text('<p>unclosed <b>tags'), 'unclosed tags')
+        self.assertEqual(extract_text('<pre> </pre>'), ' ')
+        self.assertEqual(extract_text('<p> </p>'), ' ')
+
+
+class MediaFilesTest(SimpleTestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def create_file(self, file_name, content):
+        file_path = os.path.join(self.tmp_dir, file_name)
+        with open(file_path, 'wb') as file:
+            file.write(content)
+        return file_path
+
+    def test_identical_files_are_stored_once(self):
+        first_path = self.create_file('first.mp3', b'voice')
+        copy_path = self.create_file('copy.mp3', b'voice')
+        other_path = self.create_file('other.mp3', b'VOICE')
+
+        media_files = MediaFiles()
+        file_names = [media_files.add(file_path) for file_path in [first_path, copy_path, other_path, first_path]]
+
+        self.assertEqual(file_names, ['first.mp3', 'first.mp3', 'other.mp3', 'first.mp3'])
+        self.assertEqual(media_files.pathes, [first_path, other_path])
+
+
+class WritersTest(SimpleTestCase):
+
+    def write_db(self, writer_class):
+        db_connection = sqlite3.connect(':memory:')
+        writer = writer_class(db_connection)
+        with writer.transaction():
+            writer.create_tables()
+            writer.insert_collection({'1': {'name': 'Python'}}, {})
+            writer.insert_rows([
+                (
+                    {'id': index, 'guid': f'guid{index}', 'mid': 1, 'mod': 100, 'flds': 'a', 'sfld': 'a', 'csum': 1},
+                    {'id': index, 'nid': index, 'did': 1},
+                )
+                for index in range(1, 4)
+            ])
+        return db_connection
+
+    def test_sqlite_writer_matches_sqlalchemy_writer(self):
+        queries = [
+            'SELECT type, name, sql FROM sqlite_master ORDER BY name',
+            'SELECT ver, dty, usn, ls, conf, models, decks, dconf, tags FROM col',
+            'SELECT * FROM notes ORDER BY id',
+            'SELECT id, nid, did, ord, usn, type, queue, due, data FROM cards ORDER BY id',
+        ]
+        sqlalchemy_db = self.write_db(SQLAlchemyWriter)
+        sqlite_db = self.write_db(SQLiteWriter)
+
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual(sqlite_db.execute(query).fetchall(), sqlalchemy_db.execute(query).fetchall())
+        self.assertEqual(sqlite_db.execute('SELECT COUNT(*) FROM cards').fetchone(), (3,))
+
+    def test_collection_template_has_anki_indexes(self):
+        db_connection = sqlite3.connect(':memory:')
+        load_db(db_connection, get_collection_template())
+
+        tables = db_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        indexes = db_connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        self.assertCountEqual([name for name, in tables], ['col', 'notes', 'cards', 'revlog', 'graves'])
+        self.assertIn(('ix_cards_sched',), indexes)
+        self.assertEqual(db_connection.execute('SELECT COUNT(*) FROM col').fetchone(), (0,))
+
+
+@skipUnless(shutil.which('node'), 'Node.js is not installed')
+@override_settings(MARKDOWN_RENDER_WORKERS=1)
+class RenderWorkersPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.script_path = os.path.join(tmp_dir.name, 'render_md.js')
+        with open(self.script_path, 'w') as script_file:
+            script_file.write(WORKER_SCRIPT)
+        self.addCleanup(markdown.forget_workers_pools)
+        self.addCleanup(markdown.close_workers_pools)
+
+    def test_crashed_worker_is_replaced(self):
+        self.assertEqual(markdown.render_markdown('Привет', self.script_path), '<p>Привет</p>')
+        pool = markdown.get_workers_pool(self.script_path)
+        with self.assertRaises(markdown.RenderWorkerError):
+            pool.render('crash', timeout=5)
+
+        self.assertEqual(markdown.render_markdown('Пока', self.script_path), '<p>Пока</p>')
+        self.assertFalse(pool.disabled)
+        self.assertEqual(len(pool.idle_workers), 1)
+
+    def test_worker_breaking_framing_is_replaced(self):
+        pool = markdown.get_workers_pool(self.script_path)
+        self.assertEqual(pool.render('a', timeout=5), '<p>a</p>')
+        with self.assertRaises(markdown.RenderWorkerError):
+            pool.render('warn', timeout=5)
+
+        self.assertEqual(pool.render('b', timeout=5), '<p>b</p>')
+        with self.assertRaises(markdown.BulkRenderError) as error_context:
+            markdown.render_in_bulk(['c', 'warn', 'd'], self.script_path)
+        self.assertEqual(error_context.exception.htmls, ['<p>c</p>', None, '<p>d</p>'])
+
+    @override_settings(MARKDOWN_RENDER_TIMEOUT=0.5)
+    def test_hung_text_is_not_rendered_again(self):
+        with patch.object(markdown, 'run_render_script') as run_render_script:
+            with self.assertRaises(markdown.RenderWorkerTimeout):
+                markdown.render_with_node('hang', self.script_path)
+        run_render_script.assert_not_called()
+
+    @override_settings(MARKDOWN_WORKER_RETRY_DELAY=0)
+    def test_workers_are_started_again_after_failed_start(self):
+        with patch.object(markdown, 'run_render_script', return_value='<p>a</p>') as run_render_script:
+            with override_settings(MARKDOWN_WORKER_START_TIMEOUT=0):  # as if Node.js starts too slow
+                self.assertEqual(markdown.render_with_node('a', self.script_path), '<p>a</p>')
+            self.assertEqual(markdown.render_with_node('b', self.script_path), '<p>b</p>')
+
+        run_render_script.assert_called_once()
+        self.assertTrue(markdown.get_workers_pool(self.script_path).started)
+
+    @override_settings(MARKDOWN_WORKER_START_TIMEOUT=0.5)
+    def test_script_without_worker_mode_is_run_per_render(self):
+        with open(self.script_path, 'w') as script_file:
+            script_file.write(SCRIPT_WITHOUT_WORKER_MODE)
+
+        self.assertEqual(markdown.render_with_node('Привет', self.script_path), '<p>Привет</p>')
+        self.assertTrue(markdown.get_workers_pool(self.script_path).disabled)
+        self.assertEqual(markdown.render_with_node('Пока', self.script_path), '<p>Пока</p>')
+
+    @override_settings(MARKDOWN_RENDER_WORKERS=None)
+    def test_workers_are_off_by_default(self):
+        with open(self.script_path, 'w') as script_file:
+            script_file.write(SCRIPT_WITHOUT_WORKER_MODE)
+
+        with patch.object(markdown, 'RenderWorker') as worker_class:
+            self.assertEqual(markdown.render_with_node('Привет', self.script_path), '<p>Привет</p>')
+
+        worker_class.assert_not_called()
+        self.assertIsNone(markdown.get_workers_pool(self.script_path))
+
+    def test_bulk_render_keeps_chunks_boundaries(self):
+        with self.assertRaises(markdown.BulkRenderError) as error_context:
+            markdown.render_in_bulk(['a\x07b', 'crash', 'Пока', 'a\x07b'], self.script_path)
+
+        self.assertEqual(list(error_context.exception.errors), [1])
+        self.assertEqual(error_context.exception.htmls, ['<p>a\x07b</p>', None, '<p>Пока</p>', '<p>a\x07b</p>'])
+
+    @override_settings(MARKDOWN_RENDER_WORKERS=None)
+    def test_bulk_render_without_workers_runs_script_once(self):
+        with open(self.script_path, 'w') as script_file:
+            script_file.write(SCRIPT_WITHOUT_WORKER_MODE)
+
+        with patch.object(markdown, 'run_render_script', wraps=markdown.run_render_script) as run_render_script:
+            htmls = markdown.render_in_bulk(['a', 'b', 'a\x07b', 'c'], self.script_path)
+        # Chunk with BEL is rendered by separate run, so only its own HTML is split by the script
+        self.assertEqual(htmls, ['<p>a</p>', '<p>b</p>', '<p>a</p>\x07<p>b</p>', '<p>c</p>'])
+        self.assertEqual(run_render_script.call_count, 2)
+
+        with self.assertRaises(markdown.BulkRenderError) as error_context:
+            markdown.render_in_bulk(['d', 'crash', 'e'], self.script_path)
+        self.assertEqual(list(error_context.exception.errors), [1])
+        self.assertEqual(error_context.exception.htmls, ['<p>d</p>', None, '<p>e</p>'])
+
+    def test_markup_fields_of_instances_are_rendered_together(self):
+        slengs = [Sleng(word_with_synonyms='лол', footnote_explanation=text) for text in ['Смешно', 'crash']]
+        bulk_renderer = partial(markdown.render_in_bulk, script_name=self.script_path)
+        with patch.dict(markup.BULK_RENDERERS, {'anki_markdown': bulk_renderer}):
+            failures = markup.render_markup_fields(slengs)
+
+        self.assertEqual(slengs[0]._footnote_explanation_rendered, '<p>Смешно</p>')
+        self.assertEqual([(sleng, field.name) for sleng, field, _ in failures], [(slengs[1], 'footnote_explanation')])
+
+
+class RenderCacheTest(SimpleTestCase):
+
+    def test_html_is_rendered_once(self):
+        rendered_texts = []
+
+        def render():
+            rendered_texts.append('Привет')
+            return '<p>Привет</p>'
+
+        cache_key = f'markdown:render_md.js:test:{uuid.uuid4().hex}'
+        self.addCleanup(cache.delete, cache_key)
+        render_cache = markdown.RenderCache(max_size=10)
+        for _ in range(2):
+            self.assertEqual(render_cache.get_or_render(cache_key, render), '<p>Привет</p>')
+        render_cache.clear()  # as if another process renders the same text
+        self.assertEqual(render_cache.get_or_render(cache_key, render), '<p>Привет</p>')
+
+        self.assertEqual(rendered_texts, ['Привет'])
+        self.assertEqual(render_cache.stats, {'misses': 1, 'memory_hits': 1, 'shared_hits': 1})
+
+
+class MarkdownRendererMixin:
+    """Replace Node.js render script with wrapping of markdown into paragraph and create author of cards.
+
+    Texts of every render call are kept in `rendered_chunks`.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.rendered_chunks = []
+        patcher = patch.dict(markup.BULK_RENDERERS, {'anki_markdown': self.render_in_bulk})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.author = get_user_model().objects.create(username='card_author')
+
+    def render_in_bulk(self, texts):
+        self.rendered_chunks.append(texts)
+        return [f'<p>{text}</p>' if text else '' for text in texts]
+
+
+class PrerenderMarkupTest(MarkdownRendererMixin, TestCase):
+
+    def test_card_markup_is_rendered_with_one_call(self):
+        card = BasicCard.objects.create(front='Вопрос', explanation='Ответ', created_by=self.author)
+
+        self.assertEqual(self.rendered_chunks, [['Вопрос', 'Ответ']])
+        saved_card = BasicCard.objects.get(pk=card.pk)
+        self.assertEqual(saved_card.front.rendered, '<p>Вопрос</p>')
+        self.assertIn('<p>Ответ</p>', saved_card.anki_flds)
+
+        saved_card.answer = '42'
+        saved_card.save()
+        saved_card.explanation = 'Другой ответ'
+        saved_card.save()
+        self.assertEqual(self.rendered_chunks, [['Вопрос', 'Ответ'], ['Другой ответ']])
+        self.assertIn('<p>Другой ответ</p>', BaseCard.objects.get(pk=card.pk).anki_flds)
+
+    def test_batch_is_rendered_with_one_call(self):
+        slengs = [Sleng(word_with_synonyms=word, footnote_explanation=word) for word in ['лол', 'кек']]
+        markup.prerender_markup(slengs)
+        for sleng in slengs:
+            sleng.save()
+
+        self.assertEqual(self.rendered_chunks, [['лол', 'кек']])
+        self.assertEqual(Sleng.objects.get(pk=slengs[1].pk).footnote_explanation.rendered, '<p>кек</p>')
+
+
+class RerenderMarkdownTest(MarkdownRendererMixin, TestCase):
+
+    def setUp(self):
+        self.html_template = '<p>{}</p>'
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.state_path = os.path.join(tmp_dir.name, 'state.json')
+
+        self.cards = [BasicCard.objects.create(front=f'Вопрос {index}', created_by=self.author) for index in range(3)]
+        self.html_template = '<div>{}</div>'  # as if render script is updated
+
+    def render_in_bulk(self, texts):
+        htmls = [None if text == 'crash' else self.html_template.format(text) for text in texts]
+        errors = {position: 'Render script has crashed' for position, html in enumerate(htmls) if html is None}
+        if errors:
+            raise markdown.BulkRenderError(errors, htmls)
+        return htmls
+
+    def rerender(self, *args):
+        call_command(
+            'rerender_markdown',
+            '--models=basiccard',
+            f'--state-file={self.state_path}',
+            *args,
+            stdout=StringIO(),
+            stderr=StringIO(),
+        )
+
+    def get_fronts_htmls(self):
+        return [BasicCard.objects.get(pk=card.pk).front.rendered for card in self.cards]
+
+    def test_interrupted_render_is_resumed(self):
+        state = {'anki_cards.BasicCard': {'last_pk': self.cards[1].pk, 'failed_pks': [self.cards[0].pk]}}
+        with open(self.state_path, 'w') as state_file:
+            json.dump(state, state_file)
+
+        self.rerender()
+
+        self.assertEqual(self.get_fronts_htmls(), ['<div>Вопрос 0</div>', '<p>Вопрос 1</p>', '<div>Вопрос 2</div>'])
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_dry_run_saves_nothing(self):
+        self.rerender('--dry-run')
+
+        self.assertEqual(self.get_fronts_htmls(), [f'<p>Вопрос {index}</p>' for index in range(3)])
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_failed_rows_are_rendered_on_next_run(self):
+        BasicCard.objects.filter(pk=self.cards[1].pk).update(front='crash')
+
+        with self.assertRaisesMessage(CommandError, 'Markdown of 1 rows failed to render'):
+            self.rerender()
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+        self.assertEqual(state['anki_cards.BasicCard'], {'last_pk': self.cards[2].pk, 'failed_pks': [self.cards[1].pk]})
+        self.assertEqual(self.get_fronts_htmls(), ['<div>Вопрос 0</div>', '<p>Вопрос 1</p>', '<div>Вопрос 2</div>'])
+
+        BasicCard.objects.filter(pk=self.cards[1].pk).update(front='Исправленный вопрос')
+        self.rerender()
+        self.assertEqual(self.get_fronts_htmls()[1], '<div>Исправленный вопрос</div>')
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_edited_rows_are_not_overwritten(self):
+        cards = list(BasicCard.objects.order_by('pk'))
+        rerender_markdown.rerender_chunk(cards, ['_front_rendered'])
+        edited_card = BasicCard.objects.get(pk=cards[0].pk)
+        edited_card.front = 'Новый вопрос'
+        edited_card.save()  # while the chunk was rendered
+
+        saved_cards = rerender_markdown.save_unedited_instances(BasicCard, cards, ['_front_rendered'])
+
+        self.assertEqual(saved_cards, cards[1:])
+        self.assertEqual(self.get_fronts_htmls()[0], '<div>Новый вопрос</div>')
+
+
+def serialize_note_fields_with_beautifulsoup(*fields):
+    # Fields of notes exported before precomputing were serialized on the fly this way
+    flds = ANKI_FIELDS_DELIMITER.join(fields)
+    sfld = BeautifulSoup(flds.split(ANKI_FIELDS_DELIMITER)[0], 'lxml').get_text()
+    return flds, sfld, calc_checksum(sfld)
+
+
+def spy_method(cls, name):
+    # Calls are recorded with `self` argument and passed to the original method
+    return patch.object(cls, name, autospec=True, side_effect=getattr(cls, name))
+
+
+def read_anki2_rows(apkg_file, query):
+    """Return rows of collection database from .apkg file path or file-like object."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with zipfile.ZipFile(apkg_file) as archive:
+            db_path = archive.extract('collection.anki2', tmp_dir)
+        db_connection = sqlite3.connect(db_path)
+        try:
+            return db_connection.execute(query).fetchall()
+        finally:
+            db_connection.close()
+
+
+class AnkiFieldsTest(MarkdownRendererMixin, TestCase):
+
+    def test_precomputed_fields_match_old_serialization(self):
+        basic_card = BasicCard.objects.create(front='Что выведет `a < b`?', answer='True', created_by=self.author)
+        english_card = EnglishCard(
+            word='w0',
+            word_translation='с0',
+            phrase='phrase',
+            phrase_translation='фраза',
+            created_by=self.author,
+        )
+        english_card.acting_voice.name = 'acting_voices/EnglishPhraseVoice.mp3'
+        english_card.save()
+
+        self.assertEqual(
+            (basic_card.anki_flds, basic_card.anki_sfld, basic_card.anki_csum),
+            serialize_note_fields_with_beautifulsoup('<p>Что выведет `a < b`?</p>', 'True', ''),
+        )
+        english_front = (
+            'w0\n' + ' ' * 36 + '<p>phrase</p>\n' + ' ' * 36 + '[sound:EnglishPhraseVoice.mp3]\n' + ' ' * 32
+        )
+        english_back = ' <p>фраза</p>\n' + ' ' * 36 + 'с0\n' + ' ' * 32
+        self.assertEqual(
+            (english_card.anki_flds, english_card.anki_sfld, english_card.anki_csum),
+            serialize_note_fields_with_beautifulsoup(english_front, english_back),
+        )
+
+    def test_empty_fields_are_backfilled(self):
+        card = BasicCard.objects.create(front='Вопрос', explanation='Ответ', created_by=self.author)
+        precomputed_fields = BaseCard.objects.values_list('anki_flds', 'anki_sfld', 'anki_csum').get(pk=card.pk)
+        BaseCard.objects.update(anki_flds='', anki_sfld='', anki_csum=None)  # as if saved before precomputing
+
+        call_command('backfill_anki_fields', stdout=StringIO(), stderr=StringIO())
+
+        fields = BaseCard.objects.values_list('anki_flds', 'anki_sfld', 'anki_csum').get(pk=card.pk)
+        self.assertEqual(fields, precomputed_fields)
+        self.assertGreater(BaseCard.objects.get(pk=card.pk).updated_at, card.updated_at)  # cached decks are stale
+        self.assertEqual(fields, serialize_note_fields_with_beautifulsoup('<p>Вопрос</p>', '', '<p>Ответ</p>'))
+
+
+class CardTypeTest(MarkdownRendererMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        media_root_override = override_settings(MEDIA_ROOT=media_dir.name)
+        media_root_override.enable()
+        self.addCleanup(media_root_override.disable)
+        os.mkdir(os.path.join(media_dir.name, 'acting_voices'))
+        with open(os.path.join(media_dir.name, 'acting_voices', 'voice.mp3'), 'wb') as voice_file:
+            voice_file.write(b'voice')
+
+        self.author.is_staff = self.author.is_superuser = True  # exports cards in admin
+        self.author.save()
+        self.deck = Deck.objects.create(name='Mixed', slug='mixed')
+
+    def create_cards(self, count):
+        for index in range(count):
+            BasicCard.objects.create(front=f'Вопрос {index}', deck=self.deck, created_by=self.author, published=True)
+            english_card = EnglishCard(
+                word=f'w{index}',
+                word_translation=f'с{index}',
+                phrase='phrase',
+                phrase_translation='фраза',
+                deck=self.deck,
+                created_by=self.author,
+                published=True,
+            )
+            english_card.acting_voice.name = 'acting_voices/voice.mp3'
+            english_card.save()
+            english_card.tags.add('english')
+
+    def test_migration_fills_card_type(self):
+        self.create_cards(1)
+        BaseCard.objects.create(deck=self.deck, created_by=self.author)
+        BaseCard.objects.update(card_type='')  # as before migration
+
+        migration = importlib.import_module('anki_cards.migrations.0060_basecard_card_type')
+        migration.fill_card_type(apps, None)
+
+        card_types = BaseCard.objects.order_by('pk').values_list('card_type', flat=True)
+        self.assertEqual(list(card_types), ['basiccard', 'englishcard', ''])
+
+    def test_admin_export_queries_count_does_not_depend_on_cards_count(self):
+        request = RequestFactory().get('/')
+        request.user = self.author
+        model_admin = BaseCardAdmin(BaseCard, site)
+
+        queries_counts = []
+        for cards_count in [1, 3]:
+            self.create_cards(cards_count)
+            with CaptureQueriesContext(connection) as queries:
+                dataset = BaseCardsResource().export(model_admin.get_export_queryset(request))
+            queries_counts.append(len(queries))
+        self.assertEqual(queries_counts[0], queries_counts[1])
+        self.assertIn('english', dataset['tags'])
+        self.assertEqual(dataset['basiccard_front'].count('Вопрос 0'), 2)  # created for both counts
+
+        # Every child table is read by its own query, not joined to cards of another type
+        for table in [BasicCard._meta.db_table, EnglishCard._meta.db_table]:
+            table_queries = [query['sql'] for query in queries if f'FROM "{table}"' in query['sql']]
+            self.assertEqual(len(table_queries), 1)
+            self.assertFalse(any(f'LEFT OUTER JOIN "{table}"' in query['sql'] for query in queries))
+
+    def test_mixed_deck_is_exported(self):
+        self.create_cards(1)
+        BaseCard.objects.create(deck=self.deck, created_by=self.author, published=True)  # has no fields to export
+
+        response = self.client.get(reverse('download_anki_deck'), {'deck': 'mixed'})
+
+        self.assertEqual(response.status_code, 200)
+        apkg_file = BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(apkg_file) as archive:
+            self.assertIn('0', archive.namelist())  # acting voice
+        notes = read_anki2_rows(apkg_file, 'SELECT sfld FROM notes ORDER BY id')
+        self.assertCountEqual([sfld.split('\n')[0] for sfld, in notes], ['Вопрос 0', 'w0'])
+        (models,), = read_anki2_rows(apkg_file, 'SELECT models FROM col')
+        self.assertEqual(len(json.loads(models)), 2)
+
+
+class ExportCardsTest(MarkdownRendererMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.apkg_path = os.path.join(tmp_dir.name, 'deck.apkg')
+
+        deck = Deck.objects.create(name='Python', slug='python')
+        self.cards = [
+            BasicCard.objects.create(front=f'Вопрос {index}', deck=deck, created_by=self.author, published=True)
+            for index in range(5)
+        ]
+
+    def test_cards_are_written_by_chunks_in_one_transaction(self):
+        cards_ids = [card.pk for card in reversed(self.cards)]
+        for writer_name, writer_class in [('sqlalchemy', SQLAlchemyWriter), ('sqlite3', SQLiteWriter)]:
+            with self.subTest(writer=writer_name), override_settings(ANKI_EXPORT_WRITER=writer_name):
+                with spy_method(writer_class, 'transaction') as transaction_spy:
+                    with spy_method(writer_class, 'insert_rows') as insert_rows_spy:
+                        export_cards(self.apkg_path, BaseCard.objects.all(), cards_ids=cards_ids, chunk_size=2)
+
+                # One transaction for collection row and one for all notes and cards
+                self.assertEqual(transaction_spy.call_count, 2)
+                self.assertEqual([len(call.args[1]) for call in insert_rows_spy.call_args_list], [2, 2, 1])
+                notes = read_anki2_rows(self.apkg_path, 'SELECT id, guid FROM notes ORDER BY id')
+                self.assertEqual(notes, [(anki2_id, card.guid) for anki2_id, card in enumerate(self.cards[::-1], 1)])
+                cards = read_anki2_rows(self.apkg_path, 'SELECT id, nid FROM cards ORDER BY id')
+                self.assertEqual(cards, [(anki2_id, anki2_id) for anki2_id in range(1, 6)])
+
+    def test_small_deck_is_built_in_memory(self):
+        collections = []
+        for in_memory_max_cards, temporary_files_count in [(5, 0), (4, 1)]:
+            with self.subTest(in_memory_max_cards=in_memory_max_cards):
+                with override_settings(ANKI_EXPORT_IN_MEMORY_MAX_CARDS=in_memory_max_cards), \
+                        patch.object(tempfile, 'NamedTemporaryFile', wraps=tempfile.NamedTemporaryFile) as file_class:
+                    export_cards(self.apkg_path, BaseCard.objects.all())
+
+                self.assertEqual(file_class.call_count, temporary_files_count)
+                collections.append(read_anki2_rows(self.apkg_path, 'SELECT * FROM notes ORDER BY id'))
+        self.assertEqual(len(collections[0]), 5)
+        self.assertEqual(collections[0], collections[1])
+
+
+# Child processes can't see data of uncommitted transaction, so test data is committed
+@skipUnless(can_fork(), 'Processes can not be forked')
+class ParallelExportTest(MarkdownRendererMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        media_root_override = override_settings(MEDIA_ROOT=self.tmp_dir)
+        media_root_override.enable()
+        self.addCleanup(media_root_override.disable)
+        os.mkdir(os.path.join(self.tmp_dir, 'acting_voices'))
+
+        for root_slug in ['python', 'javascript']:
+            root_deck = Deck.objects.create(name=root_slug.title(), slug=root_slug)
+            deck = Deck.objects.create(name='Basics', slug=f'{root_slug}-basics', parent=root_deck)
+            for index in range(5):
+                BasicCard.objects.create(
+                    front=f'{root_slug} {index}',
+                    deck=deck,
+                    created_by=self.author,
+                    published=True,
+                )
+
+            # Same phrase is voiced in both root decks, its file should be exported once
+            with open(os.path.join(self.tmp_dir, 'acting_voices', f'{root_slug}.mp3'), 'wb') as voice_file:
+                voice_file.write(b'voice')
+            english_card = EnglishCard(
+                word=root_slug,
+                word_translation=root_slug,
+                phrase='phrase',
+                phrase_translation='фраза',
+                deck=deck,
+                created_by=self.author,
+                published=True,
+            )
+            english_card.acting_voice.name = f'acting_voices/{root_slug}.mp3'
+            english_card.save()
+
+    def read_collection(self, processes):
+        apkg_path = os.path.join(self.tmp_dir, f'{processes}.apkg')
+        cards_query = BaseCard.objects.order_by('?')
+        cards_ids = list(BaseCard.objects.order_by('-pk').values_list('pk', flat=True))
+        export_cards(apkg_path, cards_query, cards_ids=cards_ids, chunk_size=3, processes=processes)
+
+        with zipfile.ZipFile(apkg_path) as archive:
+            db_path = archive.extract('collection.anki2', os.path.join(self.tmp_dir, str(processes)))
+            media = json.loads(archive.read('media'))
+        db_connection = sqlite3.connect(db_path)
+        self.addCleanup(db_connection.close)
+        return [
+            media,
+            *[
+                db_connection.execute(query).fetchall()
+                for query in [
+                    'SELECT models, decks FROM col',
+                    'SELECT id, guid, mid, flds, sfld, csum FROM notes ORDER BY id',
+                    'SELECT id, nid, did, ord, due FROM cards ORDER BY id',
+                ]
+            ],
+        ]
+
+    def test_parallel_export_matches_serial_export(self):
+        serial_collection = self.read_collection(processes=1)
+        with patch('anki_cards.export.apkg.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool_class:
+            parallel_collection = self.read_collection(processes=2)
+
+        pool_class.assert_called_once()
+        self.assertEqual(serial_collection[0], {'0': 'javascript.mp3'})
+        self.assertEqual(len(serial_collection[2]), 12)
+        self.assertEqual(parallel_collection, serial_collection)
+
+    @override_settings(ANKI_EXPORT_PROCESSES=2, ANKI_EXPORT_JOBS_HEARTBEAT_INTERVAL=0.001)
+    def test_job_is_exported_in_parallel_while_heartbeat_is_running(self):
+        with override_settings(ANKI_EXPORT_JOBS_DIR=self.tmp_dir):
+            create_export_job(get_export_params(QueryDict('deck=python&deck=javascript')), 'decks.apkg')
+            job = claim_next_job()
+            with patch('anki_cards.export.apkg.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool_class:
+                run_job(job)
+
+        pool_class.assert_called_once()
+        self.assertEqual(ExportJob.objects.get().status, 'done')
+
+
+class BenchmarkExportTest(TransactionTestCase):
+
+    def test_parallel_export_requires_throwaway_database(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_anki', 'export', '--sizes', '10', '--processes', '2', stdout=StringIO())
+        self.assertFalse(Deck.objects.exists())
+
+    def test_synthetic_cards_are_deleted_if_creation_fails(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        generator_path = 'anki_cards.management.commands._synthetic_cards.generate_english_cards'
+
+        for processes in ['1', '2']:
+            with self.subTest(processes=processes), override_settings(MEDIA_ROOT=tmp_dir.name):
+                with patch(generator_path, side_effect=OSError('No space left on device')):
+                    with self.assertRaises(OSError):
+                        call_command(
+                            'benchmark_anki',
+                            'export',
+                            '--sizes', '10',
+                            '--processes', processes,
+                            '--commit-synthetic-cards',
+                            stdout=StringIO(),
+                        )
+
+                self.assertFalse(Deck.objects.exists())
+                self.assertFalse(BaseCard.objects.exists())
+                self.assertEqual(os.listdir(os.path.join(tmp_dir.name, 'acting_voices')), [])
+
+
+class DownloadDeckParamsTest(MarkdownRendererMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        deck = Deck.objects.create(name='Python', slug='python')
+        self.cards = [
+            BasicCard.objects.create(front=f'Вопрос {index}', deck=deck, created_by=self.author, published=True)
+            for index in range(8)
+        ]
+
+    def download_guids(self, **params):
+        response = self.client.get(reverse('download_anki_deck'), {'deck': 'python', **params})
+        self.assertEqual(response.status_code, 200)
+        notes = read_anki2_rows(BytesIO(b''.join(response.streaming_content)), 'SELECT guid FROM notes ORDER BY id')
+        return [guid for guid, in notes]
+
+    def test_cards_are_exported_in_requested_order(self):
+        guid_by_id = {card.pk: card.guid for card in self.cards}
+        for order in ['shuffle', 'spread']:
+            with self.subTest(order=order):
+                export_params = get_export_params(QueryDict(f'deck=python&order={order}&seed=seed'))
+                cards_ids = order_exported_cards(export_params, BaseCard.objects.all())
+
+                guids = self.download_guids(order=order, seed='seed')
+
+                self.assertEqual(guids, [guid_by_id[card_id] for card_id in cards_ids])
+
+    def test_only_cards_changed_since_are_exported(self):
+        since = timezone.now()
+        BaseCard.objects.filter(pk__in=[card.pk for card in self.cards[:6]]).update(
+            updated_at=since - timedelta(days=1),
+        )
+        changed_guids = [card.guid for card in self.cards[6:]]
+
+        for since_param in [str(since.timestamp() - 1), (since - timedelta(hours=1)).isoformat()]:
+            with self.subTest(since=since_param):
+                self.assertCountEqual(self.download_guids(since=since_param), changed_guids)
+
+    def test_invalid_since_is_not_echoed(self):
+        response = self.client.get(reverse('download_anki_deck'), {'deck': 'python', 'since': '<b>yesterday</b>'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertNotIn(b'<b>', response.content)
+
+
+class ExportJobTest(TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        jobs_dir_override = override_settings(ANKI_EXPORT_JOBS_DIR=tmp_dir.name)
+        jobs_dir_override.enable()
+        self.addCleanup(jobs_dir_override.disable)
+
+        Deck.objects.create(name='Python', slug='python')
+
+    def test_job_is_built_by_worker(self):
+        response = self.client.post(reverse('create_anki_export_job'), {'deck': 'python', 'name': 'python.apkg'})
+        self.assertEqual(response.status_code, 202)
+        job_data = response.json()
+        self.assertEqual(job_data['status'], 'pending')
+
+        duplicate_response = self.client.post(reverse('create_anki_export_job'), {'deck': ' python'})
+        self.assertEqual(duplicate_response.json()['id'], job_data['id'])
+
+        call_command('run_export_worker', '--once')
+
+        job_data = self.client.get(job_data['status_url']).json()
+        self.assertEqual(job_data['status'], 'done')
+        self.assertEqual(job_data['progress'], 1)
+
+        response = self.client.get(job_data['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('python.apkg', response['Content-Disposition'])
+        apkg_path = ExportJob.objects.get().apkg_path
+        with zipfile.ZipFile(apkg_path) as archive:
+            self.assertIn('collection.anki2', archive.namelist())
+
+    def test_job_is_not_reused_after_cards_change(self):
+        export_params = get_export_params(QueryDict('deck=python'))
+        job, _ = create_export_job(export_params, 'python.apkg')
+        self.assertEqual(create_export_job(export_params, 'python.apkg'), (job, False))
+
+        # Signals are not sent, as if cards are changed by another process or by queryset update
+        author = get_user_model().objects.create(username='card_author')
+        deck = Deck.objects.get(slug='python')
+        new_card = BaseCard(deck=deck, card_type='basiccard', created_by=author, published=True)
+        BaseCard.objects.bulk_create([new_card])
+        new_job, created = create_export_job(export_params, 'python.apkg')
+        self.assertTrue(created)
+        self.assertNotEqual(new_job, job)
+
+        with patch.object(QuerySet, 'first', return_value=None):  # as if concurrent request has queued the job
+            self.assertEqual(create_export_job(export_params, 'python.apkg'), (new_job, False))
+
+    def test_requeued_job_is_finished_only_by_last_worker(self):
+        self.client.post(reverse('create_anki_export_job'), {'deck': 'python'})
+        first_claim = claim_next_job()
+        requeue_stale_jobs(timeout=-1)  # as if the first worker has hung
+        second_claim = claim_next_job()
+
+        run_job(first_claim)
+        job = ExportJob.objects.get()
+        self.assertEqual((job.status, job.apkg_path), ('running', ''))
+
+        run_job(second_claim)
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(os.listdir(os.path.dirname(job.apkg_path)), [os.path.basename(job.apkg_path)])
+
+    def test_invalid_since_is_not_echoed(self):
+        response = self.client.post(reverse('create_anki_export_job'), {'deck': 'python', 'since': '<img src=x>'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertNotIn(b'<img', response.content)
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_cards_are_filtered_by_enhancement(self):
+        author = get_user_model().objects.create(username='card_author')
+        deck = Deck.objects.get(slug='python')
+        BaseCard.objects.create(deck=deck, card_type='basiccard', created_by=author, published=True)
+
+        cards_query, cards_ids = get_exported_cards(get_export_params(QueryDict('deck=python&enhancement=loops')))
+        self.assertEqual((cards_query.count(), cards_ids), (0, []))
+        response = self.client.post(reverse('create_anki_export_job'), {'deck': 'python', 'enhancement': 'loops'})
+        self.assertEqual(response.status_code, 202)
+
+    def test_unknown_deck_is_not_queued(self):
+        response = self.client.post(reverse('create_anki_export_job'), {'deck': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(ExportJob.objects.exists())
+
+
+class ApkgCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache = ApkgCache(tmp_dir.name, max_size=10)
+
+    def write_file(self, name, content=b'apkg', age=0):
+        path = os.path.join(self.cache.dir_path, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_least_recently_used_files_are_evicted(self):
+        old_path = self.write_file('old.apkg', b'x' * 6, age=60)
+        used_path = self.write_file('used.apkg', b'x' * 6, age=120)
+        self.cache.get('used').close()
+
+        def export(filepath):
+            with open(filepath, 'wb') as file:
+                file.write(b'x' * 4)
+
+        with self.cache.build('new', export) as apkg_file:
+            self.assertEqual(apkg_file.read(), b'x' * 4)
+
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(used_path))
+        self.assertTrue(os.path.exists(self.cache.get_path('new')))
+
+    def test_stale_temporary_files_are_removed(self):
+        stale_tmp_path = self.write_file('killed-build.tmp', age=STALE_TMP_FILE_AGE + 60)
+        building_tmp_path = self.write_file('running-build.tmp')
+
+        self.cache.evict()
+
+        self.assertFalse(os.path.exists(stale_tmp_path))
+        self.assertTrue(os.path.exists(building_tmp_path))
+
+
+class SendApkgFileTest(SimpleTestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        os.mkdir(os.path.join(self.tmp_dir, 'python decks'))
+        self.apkg_path = os.path.join(self.tmp_dir, 'python decks', 'deck.apkg')
+        with open(self.apkg_path, 'wb') as apkg_file:
+            apkg_file.write(b'apkg' * 1000)
+
+    def test_file_is_streamed(self):
+        response = send_apkg_file(self.apkg_path, 'Python deck.apkg')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], '4000')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="Python%20deck.apkg"')
+        self.assertEqual(b''.join(response.streaming_content), b'apkg' * 1000)
+        response.close()
+
+    def test_file_is_sent_by_web_server(self):
+        sendfile_settings = {
+            'ANKI_APKG_SENDFILE_ROOT': self.tmp_dir,
+            'ANKI_APKG_SENDFILE_URL': '/protected/apkg/',
+        }
+        with override_settings(ANKI_APKG_SENDFILE='x-accel-redirect', **sendfile_settings):
+            response = send_apkg_file(self.apkg_path, 'deck.apkg')
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/apkg/python%20decks/deck.apkg')
+            self.assertEqual(response.content, b'')
+
+            with self.assertRaises(ImproperlyConfigured):
+                send_apkg_file('/tmp/deck.apkg', 'deck.apkg')
+
+        with override_settings(ANKI_APKG_SENDFILE='x-sendfile', **sendfile_settings):
+            response = send_apkg_file(self.apkg_path, 'deck.apkg')
+            self.assertEqual(response['X-Sendfile'], self.apkg_path)
+            self.assertEqual(response.content, b'')
+
+    def test_built_file_is_removed_after_response(self):
+        built_pathes = []
+
+        def export_func(apkg_path):
+            built_pathes.append(apkg_path)
+            with open(apkg_path, 'wb') as apkg_file:
+                apkg_file.write(b'apkg')
+
+        response = send_built_apkg_file('deck.apkg', export_func)
+        self.assertEqual(b''.join(response.streaming_content), b'apkg')
+        response.close()
+        self.assertFalse(os.path.exists(built_pathes[0]))
+
+
+class DownloadDeckTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Deck.objects.create(name='Python', slug='python')
+
+    def test_export_stages_are_reported_in_server_timing(self):
+        response = self.client.get(reverse('download_anki_deck'), {'deck': 'python'})
+
+        self.assertEqual(response.status_code, 200)
+        stages = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages[0], 'total')
+        self.assertIn('layout', stages)
+        self.assertIn('zip', stages)
+
+    def test_invalid_order_is_not_echoed(self):
+        url = reverse('download_anki_deck')
+        response = self.client.get(url, {'deck': 'python', 'order': '<script>alert(1)</script>'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertNotIn(b'<script>', response.content)
+
+    def test_unchanged_deck_is_not_modified(self):
+        url = reverse('download_anki_deck')
+        response = self.client.get(url, {'deck': 'python'})
+        self.assertIn('public', response['Cache-Control'])
+
+        not_modified_response = self.client.get(url, {'deck': 'python'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified_response.status_code, 304)
+        self.assertEqual(not_modified_response['ETag'], response['ETag'])
+
+        Deck.objects.create(name='Basics', slug='python-basics', parent=Deck.objects.get(slug='python'))
+        changed_response = self.client.get(url, {'deck': 'python'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed_response.status_code, 200)
+        self.assertNotEqual(changed_response['ETag'], response['ETag'])
+
+    @patch.dict(markup.BULK_RENDERERS, {'anki_markdown': lambda texts: [f'<p>{text}</p>' for text in texts]})
+    def test_deck_with_deleted_card_is_modified(self):
+        author = get_user_model().objects.create(username='card_author')
+        deck = Deck.objects.get(slug='python')
+        cards = [
+            BasicCard.objects.create(front=front, deck=deck, created_by=author, published=True)
+            for front in ['Первый', 'Второй']
+        ]
+        url = reverse('download_anki_deck')
+        response = self.client.get(url, {'deck': 'python'})
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        cards[0].delete()  # modification time of the remaining card is not changed
+        changed_response = self.client.get(
+            url,
+            {'deck': 'python'},
+            HTTP_IF_NONE_MATCH=response['ETag'],
+            HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT',
+        )
+        self.assertEqual(changed_response.status_code, 200)
+
+    def test_cached_deck_download_is_resumed_by_range(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        url = reverse('download_anki_deck')
+
+        with override_settings(ANKI_APKG_CACHE_DIR=tmp_dir.name):
+            response = self.client.get(url, {'deck': 'python'})
+            content = b''.join(response.streaming_content)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+            range_response = self.client.get(
+                url,
+                {'deck': 'python'},
+                HTTP_RANGE='bytes=10-',
+                HTTP_IF_RANGE=response['ETag'],
+            )
+            self.assertEqual(range_response.status_code, 206)
+            self.assertEqual(range_response['Content-Range'], f'bytes 10-{len(content) - 1}/{len(content)}')
+            self.assertEqual(b''.join(range_response.streaming_content), content[10:])
+
+            changed_file_response = self.client.get(
+                url,
+                {'deck': 'python'},
+                HTTP_RANGE='bytes=10-',
+                HTTP_IF_RANGE='"old"',
+            )
+            self.assertEqual(changed_file_response.status_code, 200)
+            self.assertEqual(b''.join(changed_file_response.streaming_content), content)
+
+            unsatisfiable_response = self.client.get(url, {'deck': 'python'}, HTTP_RANGE=f'bytes={len(content)}-')
+            self.assertEqual(unsatisfiable_response.status_code, 416)
+
+    def test_cached_deck_evicted_during_request_is_sent(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        url = reverse('download_anki_deck')
+
+        def get_and_evict(apkg_cache, key):
+            apkg_file = original_get(apkg_cache, key)
+            apkg_cache.max_size = 0
+            apkg_cache.evict()  # by concurrent request which has built another deck
+            return apkg_file
+
+        original_get = ApkgCache.get
+        for headers, content_slice in [({}, slice(None)), ({'HTTP_RANGE': 'bytes=10-'}, slice(10, None))]:
+            with self.subTest(headers=headers), override_settings(ANKI_APKG_CACHE_DIR=tmp_dir.name):
+                content = b''.join(self.client.get(url, {'deck': 'python'}).streaming_content)
+
+                with patch.object(ApkgCache, 'get', autospec=True, side_effect=get_and_evict):
+                    response = self.client.get(url, {'deck': 'python'}, **headers)
+
+                self.assertEqual(os.listdir(tmp_dir.name), [])
+                self.assertEqual(b''.join(response.streaming_content), content[content_slice])
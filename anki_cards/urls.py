@@ -5,5 +5,8 @@ from . import views
 # This is example of download deck url: /anki/cards.apkg/?lesson=rotating-planet&deck=devman_lessons
 urlpatterns = [
     path('anki/cards.apkg', views.download_deck, name='download_anki_deck'),
+    path('anki/export-jobs/', views.create_deck_export_job, name='create_anki_export_job'),
+    path('anki/export-jobs/<uuid:job_id>/', views.show_export_job, name='anki_export_job'),
+    path('anki/export-jobs/<uuid:job_id>/cards.apkg', views.download_export_job, name='download_anki_export_job'),
     path('anki/feedback/', views.show_feedback_form, name='anki_feedback'),
 ]
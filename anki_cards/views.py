@@ -1,56 +1,306 @@
+import os
+import re
+import time
 import tempfile
-from urllib.parse import quote
-from more_itertools import flatten
+from urllib.parse import quote, urljoin
 
-from django.shortcuts import get_list_or_404, render
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.shortcuts import get_object_or_404, render
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, JsonResponse
 from django.http import Http404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
 
 from rest_framework import serializers
 
-from .models import BaseCard, Deck, Issue
+from .models import ExportJob, Issue
 from .export.apkg import export_cards
+from .export.cache import get_apkg_cache
+from .export.jobs import create_export_job
+from .export.metrics import ExportMetrics, report_metrics
+from .export.selection import (
+    InvalidExportParams,
+    filter_exported_cards,
+    get_export_params,
+    get_export_etag,
+    order_exported_cards,
+)
 
+APKG_CONTENT_TYPE = 'application/force-download'
+SENDFILE_MODES = ['x-accel-redirect', 'x-sendfile']
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
 
-def download_deck(request):
-    cards_query = BaseCard.objects.select_related('basiccard', 'englishcard', 'deck').filter(published=True)
 
-    # Перемешиваем подряд идущие карты на случай, если все они по одному и тому же улучшению код-ревью.
-    cards_query = cards_query.order_by('?')
+def remove_stale_apkg_files(dir_path, max_age):
+    """Remove .apkg files left in the directory after they were served by Nginx."""
+    expiration_time = time.time() - max_age
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.apkg') and entry.stat().st_mtime < expiration_time:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # already removed by concurrent request
 
-    requested_decks_slugs = {slug.strip() for slug in request.GET.getlist('deck')}
-    requested_decks = get_list_or_404(Deck, slug__in=requested_decks_slugs)
 
-    found_decks_slugs = {deck.slug for deck in requested_decks}
-    if found_decks_slugs < requested_decks_slugs:
-        raise Http404(f'Decks not found: {requested_decks_slugs - found_decks_slugs}')
+def send_apkg_file(apkg_path, output_file_name, apkg_file=None):
+    """Respond with .apkg file without loading it into the worker memory.
 
-    exported_decks = flatten([deck.get_descendants(include_self=True) for deck in requested_decks])
-    exported_decks = set(exported_decks)  # ORM objects will be compared by id
+    By default file is streamed with FileResponse and is closed when response is finished. Pass opened `apkg_file`
+    to stream it instead of opening the file by path, e.g. temporary file removed on close.
+    If settings.ANKI_APKG_SENDFILE is set to `x-accel-redirect` or `x-sendfile`, file distribution
+    is delegated to Nginx (Apache) and file should be located inside settings.ANKI_APKG_SENDFILE_ROOT.
+    Passed `apkg_file` is closed then.
+    """
+    sendfile_mode = getattr(settings, 'ANKI_APKG_SENDFILE', None)
+    if sendfile_mode in SENDFILE_MODES and apkg_file:
+        apkg_file.close()
 
-    cards_query = cards_query.filter(deck__in=exported_decks)
-    lessons_slugs = request.GET.getlist('lesson')
-    if lessons_slugs:
-        cards_query = cards_query.filter(lesson__slug__in=lessons_slugs)
-    enhancements_slugs = request.GET.getlist('enhancement')
-    if enhancements_slugs:
-        cards_query = cards_query.filter(enhancement__slug__in=enhancements_slugs)
+    if sendfile_mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=APKG_CONTENT_TYPE)
+        relative_path = os.path.relpath(apkg_path, settings.ANKI_APKG_SENDFILE_ROOT)
+        if relative_path.startswith(os.pardir):
+            # Otherwise Nginx answers with 404 or even sends another file, see anki_cards.checks
+            raise ImproperlyConfigured(f'{apkg_path} is outside of ANKI_APKG_SENDFILE_ROOT')
+        # URL of internal Nginx location mapped to ANKI_APKG_SENDFILE_ROOT, e.g. `/protected/apkg/`
+        response['X-Accel-Redirect'] = urljoin(settings.ANKI_APKG_SENDFILE_URL, quote(relative_path))
+    elif sendfile_mode == 'x-sendfile':
+        response = HttpResponse(content_type=APKG_CONTENT_TYPE)
+        response['X-Sendfile'] = apkg_path
+    else:
+        # Content-Length header is calculated by FileResponse from file size on disk
+        response = FileResponse(apkg_file or open(apkg_path, 'rb'), content_type=APKG_CONTENT_TYPE)
 
-    output_file_name = request.GET.get('name', 'devman_decks.apkg')
+    response['Content-Disposition'] = f'attachment; filename="{quote(output_file_name)}"'
+    return response
 
-    with tempfile.NamedTemporaryFile(suffix='.apkg') as apkg_file:
-        export_cards(apkg_file.name, cards_query)
 
-        apkg_file.flush()
+def parse_byte_range(range_header, file_size):
+    """Return (first, last) positions of the single byte range requested by Range header.
 
-        # FIXME How large apkg file can be? Should Nginx handle file disribution?
-        response = HttpResponse(apkg_file.read(), content_type='application/force-download')
-        response['Content-Disposition'] = f'attachment; filename="{quote(output_file_name)}"'
+    Return None if header is malformed or requests several ranges, whole file is sent then.
+    Range is unsatisfiable if first position is greater than last one.
+    """
+    match = BYTE_RANGE_RE.match(range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+
+    if not first:  # suffix range, e.g. `bytes=-500` is last 500 bytes
+        return max(file_size - int(last), 0), file_size - 1
+    if last and int(last) < int(first):
+        return None
+    return int(first), min(int(last), file_size - 1) if last else file_size - 1
+
+
+class FileRange:
+    """Part of opened file readable as a file, so FileResponse can stream it."""
+
+    def __init__(self, file, first, last):
+        self.file = file
+        self.file.seek(first)
+        self.remaining_size = last - first + 1
+
+    def read(self, size):
+        chunk = self.file.read(min(size, self.remaining_size))
+        self.remaining_size -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+def send_stored_apkg_file(request, apkg_path, output_file_name, etag, apkg_file=None):
+    """Respond with .apkg file kept unchanged on disk, so interrupted download can be resumed with Range request.
+
+    Range is applied only if If-Range header is absent or matches `etag` of the file, otherwise whole file is sent.
+    In sendfile modes ranges are served by Nginx (Apache). Pass opened `apkg_file` to read it instead of opening
+    the file by path, e.g. file of the cache which may be evicted meanwhile.
+    """
+    sendfile_mode = getattr(settings, 'ANKI_APKG_SENDFILE', None)
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+
+    if sendfile_mode in SENDFILE_MODES:
+        response = send_apkg_file(apkg_path, output_file_name, apkg_file=apkg_file)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
         return response
 
+    # Size is read from opened file, file found by path may be already removed or replaced
+    apkg_file = apkg_file or open(apkg_path, 'rb')
+    file_size = os.fstat(apkg_file.fileno()).st_size
+    byte_range = None
+    if range_header and if_range in [None, etag]:
+        byte_range = parse_byte_range(range_header, file_size)
+
+    if byte_range and byte_range[0] > byte_range[1]:
+        apkg_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{file_size}'
+    else:
+        first, last = byte_range or (0, file_size - 1)
+        response = FileResponse(
+            FileRange(apkg_file, first, last),
+            status=206 if byte_range else 200,
+            content_type=APKG_CONTENT_TYPE,
+        )
+        response['Content-Length'] = last - first + 1
+        if byte_range:
+            response['Content-Range'] = f'bytes {first}-{last}/{file_size}'
+        response['Content-Disposition'] = f'attachment; filename="{quote(output_file_name)}"'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
+
+
+def download_deck(request):
+    try:
+        export_params = get_export_params(request.GET)
+    except InvalidExportParams as error:
+        return HttpResponseBadRequest(str(error), content_type='text/plain')
+
+    metrics = ExportMetrics()
+    with metrics.count_queries(), metrics.stage('total'):
+        response = build_deck_response(request, export_params, metrics)
+
+    # Stages durations are shown in browser developer tools, so slow downloads can be examined without logs
+    response['Server-Timing'] = metrics.get_server_timing()
+    report_metrics(metrics, export_params=export_params)
+    return response
+
+
+def build_deck_response(request, export_params, metrics):
+    with metrics.stage('validators'):
+        exported_decks, cards_query = filter_exported_cards(export_params)
+        cards_etag = get_export_etag(export_params, exported_decks, cards_query)
+    # Every build of the same cards has other timestamps inside, so ETag of cards is weak
+    etag = f'W/{cards_etag}'
+    output_file_name = request.GET.get('name', 'devman_decks.apkg')
+
+    def export_func(filepath):
+        with metrics.stage('cards_order'):
+            cards_ids = order_exported_cards(export_params, cards_query)
+        export_cards(filepath, cards_query, cards_ids=cards_ids, metrics=metrics)
+
+    apkg_cache = get_apkg_cache()
+    cache_key = cards_etag.strip('"')
+    apkg_file = None
+    if apkg_cache:
+        # File is opened once and is served from this handle, so it may be evicted by concurrent request meanwhile
+        with metrics.stage('cache_lookup'):
+            apkg_file = apkg_cache.get(cache_key)
+        metrics.count('apkg_cache_hits', int(bool(apkg_file)))
+        if apkg_file:
+            # Artifact built again after eviction differs byte by byte, so resumed downloads need ETag of the file
+            etag = apkg_cache.get_etag(cache_key, apkg_file)
+
+    # Unchanged deck is not built at all, client or CDN already has it
+    response = get_conditional_response(request, etag=etag)
+    metrics.count('not_modified', int(response is not None))
+    if response is not None and apkg_file:
+        apkg_file.close()
+    elif response is None and apkg_cache:
+        # Repeated downloads of unchanged cards are served from disk without rebuilding
+        if not apkg_file:
+            apkg_file = apkg_cache.build(cache_key, export_func)
+            etag = apkg_cache.get_etag(cache_key, apkg_file)
+        response = send_stored_apkg_file(
+            request,
+            apkg_cache.get_path(cache_key),
+            output_file_name,
+            etag,
+            apkg_file=apkg_file,
+        )
+    elif response is None:
+        response = send_built_apkg_file(output_file_name, export_func)
+        response['Accept-Ranges'] = 'none'  # file is built again for the next request
+
+    response['ETag'] = etag
+    # Public decks may be stored by proxies, but are revalidated with ETag after max-age seconds
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'ANKI_APKG_MAX_AGE', 0))
+    return response
+
+
+def send_built_apkg_file(output_file_name, export_func):
+    """Build .apkg file to temporary file and respond with it. File is removed after it is sent."""
+    sendfile_mode = getattr(settings, 'ANKI_APKG_SENDFILE', None)
+    if sendfile_mode in SENDFILE_MODES:
+        # File should outlive the request to be sent by Nginx, so it is removed later by next downloads
+        sendfile_root = settings.ANKI_APKG_SENDFILE_ROOT
+        remove_stale_apkg_files(sendfile_root, max_age=getattr(settings, 'ANKI_APKG_SENDFILE_TTL', 3600))
+        apkg_file = tempfile.NamedTemporaryFile(suffix='.apkg', dir=sendfile_root, delete=False)
+    else:
+        # Temporary file will be closed and removed by FileResponse after the last chunk is sent
+        apkg_file = tempfile.NamedTemporaryFile(suffix='.apkg')
+
+    try:
+        export_func(apkg_file.name)
+    except:  # noqa722
+        apkg_file.close()
+        if sendfile_mode in SENDFILE_MODES:
+            os.remove(apkg_file.name)
+        raise
+
+    if sendfile_mode in SENDFILE_MODES:
+        apkg_file.close()
+        return send_apkg_file(apkg_file.name, output_file_name)
+
+    return send_apkg_file(apkg_file.name, output_file_name, apkg_file=apkg_file)
+
+
+def serialize_export_job(request, job):
+    job_data = {
+        'id': str(job.id),
+        'status': job.status,
+        'progress': round(job.progress, 3),
+        'status_url': request.build_absolute_uri(reverse('anki_export_job', args=[job.id])),
+    }
+    if job.status == 'done':
+        job_data['download_url'] = request.build_absolute_uri(reverse('download_anki_export_job', args=[job.id]))
+    if job.status == 'failed':
+        job_data['error'] = job.error
+    return job_data
+
+
+# Large decks are built by `run_export_worker` command, client polls job status until download url appears
+@csrf_exempt
+@require_http_methods(["POST"])
+def create_deck_export_job(request):
+    # Params are the same as for download_deck and may be passed both in query string and in form data
+    query_params = request.POST or request.GET
+    try:
+        export_params = get_export_params(query_params)
+    except InvalidExportParams as error:
+        return HttpResponseBadRequest(str(error), content_type='text/plain')
+
+    job, _ = create_export_job(export_params, file_name=query_params.get('name', 'devman_decks.apkg'))
+    response = JsonResponse(serialize_export_job(request, job), status=202)
+    response['Location'] = reverse('anki_export_job', args=[job.id])
+    return response
+
+
+@require_http_methods(["GET"])
+def show_export_job(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id)
+    return JsonResponse(serialize_export_job(request, job))
+
+
+def download_export_job(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id, status='done')
+    try:
+        # Opened file is served even if it expires and is removed meanwhile
+        apkg_file = open(job.apkg_path, 'rb')
+    except FileNotFoundError:
+        raise Http404('Export file is expired')
+    # Job file is never changed, so its id is a strong ETag
+    return send_stored_apkg_file(request, job.apkg_path, job.file_name, etag=f'"{job.id}"', apkg_file=apkg_file)
+
 
 class IssueSerializer(serializers.ModelSerializer):
 
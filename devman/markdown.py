@@ -1,17 +1,67 @@
-from os.path import dirname, abspath, join
+"""Markdown rendering with Node.js scripts from `js-markdown` directory.
+
+Script reads markdown from STDIN and writes HTML to STDOUT. Being started with `--serve` argument, script works as
+a long-lived render worker instead: it reads framed requests from STDIN and answers each of them with a framed
+response, so Node.js interpreter and markdown libraries are initialized once per worker, not once per render.
+Frame is a header line with byte length of UTF-8 payload followed by the payload itself:
+
+    request:  b'<length>\\n<markdown>'
+    response: b'ok <length>\\n<html>' or b'error <length>\\n<message>'
+
+Worker exits when its STDIN is closed. Script without worker mode would wait for the end of STDIN forever, so
+workers are used only if settings.MARKDOWN_RENDER_WORKERS is set, i.e. the deployed scripts support `--serve`.
+
+Rendered HTML is memoized by script name, renderer version and hash of markdown, first in process memory and
+then in Django cache shared by all processes, so unchanged markdown never reaches Node.js again.
+"""
+import os
+import time
+import hashlib
+import atexit
+import select
+import logging
+import threading
 import subprocess
-from functools import partial
+from os.path import dirname, abspath, join
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial
 
+from django.conf import settings
+from django.core.cache import caches
 
-def render_markdown(stdin_msg: str, script_name='render_md.js'):
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS_COUNT = 0  # workers are off, set settings.MARKDOWN_RENDER_WORKERS if scripts support `--serve`
+DEFAULT_RENDER_TIMEOUT = 30  # seconds, can be overriden with settings.MARKDOWN_RENDER_TIMEOUT
+DEFAULT_WORKER_START_TIMEOUT = 5  # seconds, see settings.MARKDOWN_WORKER_START_TIMEOUT
+DEFAULT_WORKER_RETRY_DELAY = 60  # seconds before new start of workers failed to start, see MARKDOWN_WORKER_RETRY_DELAY
+DEFAULT_RENDER_CACHE_SIZE = 4096  # rendered texts kept in process memory, see settings.MARKDOWN_RENDER_CACHE_SIZE
+DEFAULT_RENDER_CACHE_TIMEOUT = 30 * 24 * 60 * 60  # seconds, see settings.MARKDOWN_RENDER_CACHE_TIMEOUT
+SCRIPT_CHUNKS_DELIMITER = chr(7)  # beep symbol, chunks joined with it are rendered by one run of the script
+
+
+class RenderWorkerError(Exception):
+    pass
+
+
+class RenderWorkerTimeout(RenderWorkerError):
+    pass
+
+
+def get_script_path(script_name):
     curr_dir = dirname(dirname(abspath(__file__)))
     script_dir = join(curr_dir, 'js-markdown')
+    return join(script_dir, script_name)
+
 
+def run_render_script(stdin_msg, script_path, timeout):
     process = subprocess.run(
-        ['node', '--no-warnings', join(script_dir, script_name)],
+        ['node', '--no-warnings', script_path],
         input=stdin_msg.encode(),
         stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL
+        stderr=subprocess.DEVNULL,
+        timeout=timeout,
     )
 
     if process.returncode:
@@ -20,11 +70,409 @@ def render_markdown(stdin_msg: str, script_name='render_md.js'):
     return process.stdout.decode()
 
 
+class RenderWorker:
+    """Node.js process started in worker mode. Is used by one thread at a time."""
+
+    def __init__(self, script_path):
+        self.process = subprocess.Popen(
+            ['node', '--no-warnings', script_path, '--serve'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.buffer = bytearray()  # STDOUT is read by raw file descriptor, so reads can be timed out
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def send(self, text):
+        payload = text.encode()
+        self.process.stdin.write(b'%d\n' % len(payload))
+        self.process.stdin.write(payload)
+        self.process.stdin.flush()
+
+    def read_response(self, timeout):
+        """Return (status, text) pair of the next response.
+
+        Raise RenderWorkerError if worker hangs, exits or breaks framing, its stream can't be read any further.
+        """
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            self.fill_buffer(deadline)
+        header, _, self.buffer = self.buffer.partition(b'\n')
+        try:
+            status, payload_length = header.decode().split()
+            payload_length = int(payload_length)
+        except ValueError as error:
+            # E.g. warning printed to STDOUT, following responses can't be told apart from each other anymore
+            raise RenderWorkerError(f'Render worker sent malformed header: {header[:100]!r}') from error
+        if status not in ('ok', 'error'):
+            raise RenderWorkerError(f'Render worker sent unknown status: {status[:100]!r}')
+
+        while len(self.buffer) < payload_length:
+            self.fill_buffer(deadline)
+        payload, self.buffer = self.buffer[:payload_length], self.buffer[payload_length:]
+        try:
+            return status, payload.decode()
+        except UnicodeDecodeError as error:
+            raise RenderWorkerError('Render worker sent payload which is not UTF-8') from error
+
+    def fill_buffer(self, deadline):
+        stdout_fd = self.process.stdout.fileno()
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0 or not select.select([stdout_fd], [], [], remaining_time)[0]:
+            raise RenderWorkerTimeout('Render worker timed out')
+        data = os.read(stdout_fd, 64 * 1024)
+        if not data:
+            raise RenderWorkerError('Render worker exited')
+        self.buffer += data
+
+    def render(self, text, timeout):
+        try:
+            self.send(text)
+        except OSError as error:  # broken pipe of crashed worker
+            raise RenderWorkerError('Render worker exited') from error
+        status, payload = self.read_response(timeout)
+        if status != 'ok':
+            raise ValueError(f'Markdown render has problems: {payload}')
+        return payload
+
+    def stop(self):
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class RenderWorkersPool:
+    """Pool of render workers of one script. Crashed and hung workers are replaced with new ones."""
+
+    def __init__(self, script_path, size):
+        self.script_path = script_path
+        self.idle_workers = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.started = False  # some worker has passed health check, so script supports worker mode
+        self.retry_at = None  # workers are not started till this time after failed start
+
+    @property
+    def disabled(self):
+        return self.retry_at is not None and time.monotonic() < self.retry_at
+
+    def disable(self):
+        """Render without workers for a while. Script may have no worker mode or Node.js may start too slow."""
+        self.retry_at = time.monotonic() + getattr(settings, 'MARKDOWN_WORKER_RETRY_DELAY', DEFAULT_WORKER_RETRY_DELAY)
+
+    def start_worker(self):
+        worker = RenderWorker(self.script_path)
+        try:
+            # Health check: worker answers empty request as soon as it is ready, script without worker mode never
+            timeout = getattr(settings, 'MARKDOWN_WORKER_START_TIMEOUT', DEFAULT_WORKER_START_TIMEOUT)
+            worker.render('', timeout=timeout)
+        except (RenderWorkerError, ValueError) as error:
+            worker.stop()
+            raise RenderWorkerError('Render worker has not started') from error
+        self.started = True
+        return worker
+
+    def pop_idle_worker(self):
+        with self.lock:
+            while self.idle_workers:
+                worker = self.idle_workers.pop()
+                if worker.is_alive():
+                    return worker
+                worker.stop()
+        return None
+
+    def release_worker(self, worker):
+        with self.lock:
+            self.idle_workers.append(worker)
+
+    @contextmanager
+    def acquire(self):
+        """Lend idle or new worker. Raise RenderWorkerError if worker can't be started or has failed."""
+        with self.semaphore:
+            worker = self.pop_idle_worker() or self.start_worker()
+            try:
+                yield worker
+            except ValueError:
+                # Only `error` response of the worker is ValueError, framing problems are RenderWorkerError
+                self.release_worker(worker)  # render error reported by worker, worker is fine
+                raise
+            except BaseException:
+                worker.stop()  # worker state is unknown, so it is never reused
+                raise
+            self.release_worker(worker)
+
+    def render(self, text, timeout):
+        with self.acquire() as worker:
+            return worker.render(text, timeout)
+
+    def close(self):
+        with self.lock:
+            for worker in self.idle_workers:
+                worker.stop()
+            self.idle_workers = []
+
+
+_pools = {}  # script path -> RenderWorkersPool, pools are not shared with forked processes
+_pools_lock = threading.Lock()
+
+
+def get_workers_pool(script_path, size=None):
+    """Return workers pool of the script or None if workers are not enabled by settings.MARKDOWN_RENDER_WORKERS.
+
+    Pool is created with `size` workers if passed, with count from the setting otherwise.
+    """
+    settings_workers_count = getattr(settings, 'MARKDOWN_RENDER_WORKERS', DEFAULT_WORKERS_COUNT)
+    if not settings_workers_count:
+        return None
+    workers_count = size or settings_workers_count
+    with _pools_lock:
+        if script_path not in _pools:
+            _pools[script_path] = RenderWorkersPool(script_path, workers_count)
+        return _pools[script_path]
+
+
+def close_workers_pools():
+    for pool in list(_pools.values()):
+        pool.close()
+
+
+def forget_workers_pools():
+    # Child process should not write to pipes of parent's workers, lock may be held by parent's thread
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+atexit.register(close_workers_pools)
+os.register_at_fork(after_in_child=forget_workers_pools)
+
+
+@lru_cache(maxsize=None)
+def get_renderer_version(script_path):
+    """Return version of the render script, it is changed by deploy of new script or settings.MARKDOWN_RENDERER_VERSION.
+
+    Version of markdown libraries used by the script is not tracked, so the setting is bumped on their update.
+    """
+    try:
+        with open(script_path, 'rb') as script_file:
+            script_digest = hashlib.sha1(script_file.read()).hexdigest()[:12]
+    except FileNotFoundError:
+        script_digest = 'missing'
+    return f'{script_digest}-{getattr(settings, "MARKDOWN_RENDERER_VERSION", "")}'
+
+
+class RenderCache:
+    """Two-tier cache of rendered HTML: LRU in process memory and Django cache shared by processes.
+
+    Django cache is chosen by alias settings.MARKDOWN_RENDER_CACHE, shared tier is disabled if it is None.
+    Hits and misses of every tier are counted in `stats`.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get_shared_cache(self):
+        cache_alias = getattr(settings, 'MARKDOWN_RENDER_CACHE', 'default')
+        return caches[cache_alias] if cache_alias else None
+
+    def remember(self, key, html):
+        with self.lock:
+            self.memory[key] = html
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return dict with cached HTML of unique keys, missed keys are absent from it."""
+        found_htmls = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found_htmls[key] = self.memory[key]
+        self.stats['memory_hits'] += len(found_htmls)
+
+        shared_cache = self.get_shared_cache()
+        missed_keys = [key for key in keys if key not in found_htmls]
+        if shared_cache and missed_keys:
+            shared_htmls = shared_cache.get_many(missed_keys)
+            self.stats['shared_hits'] += len(shared_htmls)
+            for key, html in shared_htmls.items():
+                self.remember(key, html)
+            found_htmls.update(shared_htmls)
+
+        self.stats['misses'] += len(keys) - len(found_htmls)
+        return found_htmls
+
+    def set_many(self, htmls):
+        for key, html in htmls.items():
+            self.remember(key, html)
+        shared_cache = self.get_shared_cache()
+        if shared_cache and htmls:
+            timeout = getattr(settings, 'MARKDOWN_RENDER_CACHE_TIMEOUT', DEFAULT_RENDER_CACHE_TIMEOUT)
+            shared_cache.set_many(htmls, timeout=timeout)
+
+    def get_or_render(self, key, render_func):
+        html = self.get_many([key]).get(key)
+        if html is None:
+            html = render_func()
+            self.set_many({key: html})
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+
+render_cache = RenderCache(max_size=getattr(settings, 'MARKDOWN_RENDER_CACHE_SIZE', DEFAULT_RENDER_CACHE_SIZE))
+
+
+def calc_render_cache_key(script_name, script_path, text):
+    # Script name is used instead of path, so processes deployed to different directories share cache
+    text_digest = hashlib.sha256(text.encode()).hexdigest()
+    return f'markdown:{script_name}:{get_renderer_version(script_path)}:{text_digest}'
+
+
+def render_markdown(stdin_msg: str, script_name='render_md.js'):
+    script_path = get_script_path(script_name)
+    cache_key = calc_render_cache_key(script_name, script_path, stdin_msg)
+    return render_cache.get_or_render(cache_key, partial(render_with_node, stdin_msg, script_path))
+
+
+def render_with_node(stdin_msg, script_path):
+    timeout = getattr(settings, 'MARKDOWN_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT)
+
+    pool = get_workers_pool(script_path)
+    if pool and not pool.disabled:
+        try:
+            return pool.render(stdin_msg, timeout)
+        except RenderWorkerTimeout:
+            raise  # the text hangs renderer, new Node.js process would wait for the same timeout once more
+        except RenderWorkerError:
+            if not pool.started:
+                logger.warning('Render workers of %s failed to start, Node.js is started per render', script_path)
+                pool.disable()
+            # Otherwise worker has crashed, it is replaced and the text is rendered once more
+
+    return run_render_script(stdin_msg, script_path, timeout)
+
+
 render_anki_markdown = partial(render_markdown, script_name='render_anki_md.js')
 
 
-def render_in_bulk(render_function, raw_chunks):
-    """Speedup markdown rendering by avoiding multiple slow initializations of Node.js interpreter."""
-    delimiter = chr(7)  # beep symbol, is supported by JS script
-    joined_html = render_function(delimiter.join(raw_chunks))
-    return joined_html.split(delimiter)
+class BulkRenderError(ValueError):
+    """Some of chunks have not been rendered.
+
+    `errors` maps positions of failed chunks to error messages, `htmls` has HTML of the rendered chunks
+    and None in place of failed ones.
+    """
+
+    def __init__(self, errors, htmls):
+        super().__init__(f'Markdown render has problems with {len(errors)} of {len(htmls)} chunks')
+        self.errors = errors
+        self.htmls = htmls
+
+
+def iter_rendered_by_worker(pool, texts, timeout):
+    """Yield (html, error) pair for every text. Texts are streamed to worker one by one, not joined together.
+
+    Text which crashes or hangs the worker gets an error, following texts are rendered by a new worker.
+    Raise RenderWorkerError if script has no worker mode.
+    """
+    position = 0
+    while position < len(texts):
+        try:
+            with pool.acquire() as worker:
+                for text in texts[position:]:
+                    try:
+                        yield worker.render(text, timeout), None
+                    except ValueError as error:
+                        yield None, str(error)
+                    position += 1
+        except RenderWorkerError as error:
+            if not pool.started:
+                raise
+            yield None, str(error)
+            position += 1
+
+
+def iter_rendered_by_script(texts, script_path, timeout):
+    """Yield (html, error) pair for every text. Texts are joined with BEL and rendered by one Node.js run.
+
+    Texts with BEL inside would shift boundaries of other texts, so they are rendered one by one. So are all texts
+    if the joined run fails, to find out the failed ones.
+    """
+    joined_positions = [position for position, text in enumerate(texts) if SCRIPT_CHUNKS_DELIMITER not in text]
+    position_to_html = {}
+    if joined_positions:
+        joined_text = SCRIPT_CHUNKS_DELIMITER.join(texts[position] for position in joined_positions)
+        try:
+            htmls = run_render_script(joined_text, script_path, timeout).split(SCRIPT_CHUNKS_DELIMITER)
+        except (ValueError, subprocess.TimeoutExpired):
+            htmls = []
+        if len(htmls) == len(joined_positions):
+            position_to_html = dict(zip(joined_positions, htmls))
+
+    for position, text in enumerate(texts):
+        if position in position_to_html:
+            yield position_to_html[position], None
+            continue
+        try:
+            yield run_render_script(text, script_path, timeout), None
+        except (ValueError, subprocess.TimeoutExpired) as error:
+            yield None, str(error)
+
+
+def render_in_bulk(raw_chunks, script_name='render_md.js'):
+    """Render many markdown chunks through a single Node.js worker or run instead of slow start of Node.js per chunk.
+
+    Chunks are rendered in order and their boundaries are kept by framing of workers, so chunks may contain any
+    characters. Without workers chunks with BEL are rendered separately, so they never break other chunks.
+    Cached chunks and duplicates are not rendered again. Return list of HTML of chunks.
+    Raise BulkRenderError if some of chunks have failed, HTML of all other chunks is kept in the error.
+    """
+    script_path = get_script_path(script_name)
+    timeout = getattr(settings, 'MARKDOWN_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT)
+
+    chunks_keys = [calc_render_cache_key(script_name, script_path, chunk) for chunk in raw_chunks]
+    key_to_chunk = dict(zip(chunks_keys, raw_chunks))
+    key_to_html = render_cache.get_many(list(key_to_chunk))
+    missed_keys = [key for key in key_to_chunk if key not in key_to_html]
+    missed_chunks = [key_to_chunk[key] for key in missed_keys]
+
+    results = None
+    pool = get_workers_pool(script_path)
+    if pool and not pool.disabled:
+        try:
+            results = list(iter_rendered_by_worker(pool, missed_chunks, timeout))
+        except RenderWorkerError:
+            logger.warning('Render workers of %s failed to start, Node.js is started per render', script_path)
+            pool.disable()
+    if results is None:
+        results = list(iter_rendered_by_script(missed_chunks, script_path, timeout))
+
+    key_to_error = {}
+    rendered_htmls = {}
+    for key, (html, error) in zip(missed_keys, results):
+        if error is None:
+            rendered_htmls[key] = html
+        else:
+            key_to_error[key] = error
+    render_cache.set_many(rendered_htmls)
+    key_to_html.update(rendered_htmls)
+
+    htmls = [key_to_html.get(key) for key in chunks_keys]
+    errors = {position: key_to_error[key] for position, key in enumerate(chunks_keys) if key in key_to_error}
+    if errors:
+        raise BulkRenderError(errors, htmls)
+    return htmls
+
+
+render_anki_markdown_in_bulk = partial(render_in_bulk, script_name='render_anki_md.js')